@@ -0,0 +1,310 @@
+"""
+Caching helpers for the mobile apps API.
+
+Responses carry a strong ETag and a Last-Modified header derived from the
+`modified` column of the objects they return. Membership changes don't touch
+`modified`, so they are tracked by generation counters kept in the cache and
+folded into the ETag as well, while the time they were last bumped is folded
+into Last-Modified. The same counters key the payloads kept by
+`ReadThroughCache`. POSTs carrying an `Idempotency-Key` header keep their
+response in the cache, so that retries can be answered without running again.
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import status
+from rest_framework.response import Response
+
+GENERATION_CACHE_KEY = 'mobileapps.generation.{}'
+GENERATION_TIME_CACHE_KEY = 'mobileapps.generation_time.{}'
+
+# Bumped when the users or organizations of any mobile app change.
+MOBILE_APPS_GENERATION = 'mobile_apps'
+
+
+def get_mobile_app_generation_name(mobile_app_id):
+    """
+    Returns the name of the generation counter bumped when the members of a mobile app change.
+    """
+    return 'mobile_app.{}'.format(mobile_app_id)
+
+
+def get_user_organizations_generation_name(user_id):
+    """
+    Returns the name of the generation counter bumped when the organizations of a user change.
+    """
+    return 'user_organizations.{}'.format(user_id)
+
+
+def _initial_generation():
+    # Counters start from the clock rather than zero, so a counter evicted from the
+    # cache never repeats a generation an earlier ETag was built from.
+    return int(time.time() * 1000000)
+
+
+def get_generations(names):
+    """
+    Returns the current values of the named generation counters, in order.
+    """
+    keys = [GENERATION_CACHE_KEY.format(name) for name in names]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            cache.add(key, _initial_generation(), None)
+            generations[key] = cache.get(key)
+    return [generations[key] for key in keys]
+
+
+def get_generation_times(names):
+    """
+    Returns the times the named generation counters were last bumped, in order.
+
+    Counters with no known time, e.g. evicted from the cache, count as bumped now.
+    """
+    keys = [GENERATION_TIME_CACHE_KEY.format(name) for name in names]
+    times = cache.get_many(keys)
+    for key in keys:
+        if key not in times:
+            cache.add(key, time.time(), None)
+            times[key] = cache.get(key)
+    return [times[key] for key in keys]
+
+
+def bump_generations(names):
+    """
+    Increments the named generation counters, so the ETags and cached values built from them change.
+    """
+    for name in names:
+        key = GENERATION_CACHE_KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_generation(), None)
+    now = time.time()
+    cache.set_many({GENERATION_TIME_CACHE_KEY.format(name): now for name in names}, None)
+    for read_through_cache in _read_through_caches:
+        read_through_cache.discard(names)
+
+
+def bump_generations_on_commit(names, using=None):
+    """
+    Bumps the named generation counters now, and again once the current transaction
+    commits, so values other processes cached from the data before the commit are
+    discarded as well.
+    """
+    bump_generations(names)
+    transaction.on_commit(lambda: bump_generations(names), using=using)
+
+
+CacheInfo = namedtuple('CacheInfo', ['local_hits', 'hits', 'misses', 'local_size'])
+
+_read_through_caches = []
+
+
+class ReadThroughCache:
+    """
+    Keeps computed values in the shared cache under the generation counters they
+    depend on, with a small per-process cache in front of it.
+
+    The per-process cache saves a round trip to the shared cache for hot keys, at
+    the cost of serving values up to `local_timeout` seconds old after another
+    process bumped their counters; bumps made in this process drop them at once.
+    """
+
+    def __init__(self, prefix, timeout, local_timeout, local_size):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.local_timeout = local_timeout
+        self.local_size = local_size
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._local_hits = self._hits = self._misses = 0
+        _read_through_caches.append(self)
+
+    def get(self, key, generation_names, compute):
+        """
+        Returns the value cached for `key`, calling `compute()` to build it on a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(key)
+                self._local_hits += 1
+                return entry[2]
+
+        generations = get_generations(generation_names)
+        shared_key = '{}.{}.{}'.format(self.prefix, key, '.'.join(str(generation) for generation in generations))
+        value = cache.get(shared_key)
+        hit = value is not None
+        if not hit:
+            value = compute()
+            cache.set(shared_key, value, self.timeout)
+
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            self._local[key] = (now + self.local_timeout, frozenset(generation_names), value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+        return value
+
+    def discard(self, generation_names):
+        """
+        Drops the values of this process built from any of the named generation counters.
+        """
+        generation_names = set(generation_names)
+        with self._lock:
+            for key in [key for key, entry in self._local.items() if entry[1] & generation_names]:
+                del self._local[key]
+
+    def clear(self):
+        """
+        Drops all the values of this process and resets its counters.
+        """
+        with self._lock:
+            self._local.clear()
+            self._local_hits = self._hits = self._misses = 0
+
+    def info(self):
+        """
+        Returns the hit and miss counters of this process.
+        """
+        with self._lock:
+            return CacheInfo(self._local_hits, self._hits, self._misses, len(self._local))
+
+
+class IdempotentPostMixin:
+    """
+    Replays the response of a successful POST for later POSTs carrying the same
+    `Idempotency-Key` header, from the same user to the same URL, instead of
+    running them again. Views implement `idempotent_post()` instead of `post()`.
+
+    Responses are kept for MOBILEAPPS_IDEMPOTENCY_KEY_TIMEOUT seconds. A POST
+    arriving while the first one with its key is still running gets an HTTP 409
+    "Conflict" response; that claim only lasts MOBILEAPPS_IDEMPOTENCY_IN_PROGRESS_TIMEOUT
+    seconds, so a key whose POST was killed can be retried once it expires. Keys
+    of failed POSTs are released at once. A POST reusing a key with a different
+    body gets an HTTP 422 "Unprocessable Entity" response.
+    """
+    IN_PROGRESS = 'in-progress'
+
+    def get_idempotency_cache_key(self, request):
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not idempotency_key:
+            return None
+        digest = hashlib.sha1('{} {}'.format(request.path, idempotency_key).encode('utf-8')).hexdigest()
+        return 'mobileapps.idempotency.{}.{}'.format(request.user.id, digest)
+
+    def get_request_digest(self, request):
+        data = request.data
+        if hasattr(data, 'lists'):
+            data = dict(data.lists())
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def idempotent_post(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def post(self, request, *args, **kwargs):
+        cache_key = self.get_idempotency_cache_key(request)
+        if cache_key is None:
+            return self.idempotent_post(request, *args, **kwargs)
+
+        timeout = getattr(settings, 'MOBILEAPPS_IDEMPOTENCY_KEY_TIMEOUT', 24 * 60 * 60)
+        # Longer than a request may run for, so the claim outlives the POST holding it.
+        in_progress_timeout = getattr(settings, 'MOBILEAPPS_IDEMPOTENCY_IN_PROGRESS_TIMEOUT', 5 * 60)
+        digest = self.get_request_digest(request)
+        if not cache.add(cache_key, {'status': self.IN_PROGRESS, 'digest': digest}, in_progress_timeout):
+            stored = cache.get(cache_key)
+            if stored is not None and stored['digest'] != digest:
+                return Response(
+                    {'message': _('This Idempotency-Key was used with a different request body')},
+                    status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if stored is None or stored['status'] == self.IN_PROGRESS:
+                return Response(
+                    {'message': _('A request with this Idempotency-Key is in progress')}, status.HTTP_409_CONFLICT,
+                )
+            return Response(stored['data'], stored['status'])
+
+        try:
+            response = self.idempotent_post(request, *args, **kwargs)
+        except Exception:
+            cache.delete(cache_key)
+            raise
+        if 200 <= response.status_code < 300:
+            cache.set(cache_key, {'status': response.status_code, 'digest': digest, 'data': response.data}, timeout)
+        else:
+            cache.delete(cache_key)
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET requests with an HTTP 304 "Not Modified" response when their
+    `If-None-Match` or `If-Modified-Since` header matches the current response.
+
+    The validators come from a single aggregate query over
+    `get_conditional_queryset()`, which must return the objects the response is
+    built from, and from the counters named by `get_generation_names()`.
+    """
+
+    def get_conditional_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    def get_generation_names(self):
+        return []
+
+    def get_conditional_validators(self):
+        """
+        Returns the `(etag, last_modified)` of the response, or None when there
+        is nothing to return, e.g. the response is an HTTP 404.
+        """
+        aggregates = self.get_conditional_queryset().aggregate(count=Count('pk'), last_modified=Max('modified'))
+        if aggregates['last_modified'] is None:
+            return None
+
+        user = self.request.user
+        generation_names = self.get_generation_names()
+        if not user.is_staff:
+            # What non-staff users see is scoped by their organizations.
+            generation_names = generation_names + [get_user_organizations_generation_name(user.id)]
+        state = (
+            self.request.get_full_path(),
+            None if user.is_staff else user.id,
+            aggregates['count'],
+            aggregates['last_modified'].isoformat(),
+            get_generations(generation_names),
+        )
+        etag = quote_etag(hashlib.sha1(repr(state).encode('utf-8')).hexdigest())
+        # Membership changes don't touch `modified`, so the response is as new as
+        # the latest bump of its counters when that is more recent.
+        last_modified = max([aggregates['last_modified'].timestamp()] + get_generation_times(generation_names))
+        return etag, int(last_modified)
+
+    def get(self, request, *args, **kwargs):
+        validators = self.get_conditional_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+
+        etag, last_modified = validators
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
@@ -0,0 +1,28 @@
+"""
+Management command to report how the calls to notification providers were rate limited.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mobileapps.models import NotificationProvider
+from mobileapps.throttling import EVENTS, get_rate_limit_metrics
+
+
+class Command(BaseCommand):
+    """
+    Prints the counters kept by `mobileapps.throttling` for each notification provider.
+    """
+    help = 'Prints the number of calls to notification providers allowed, throttled, retried and dropped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('providers', nargs='*', help='Names of the providers, all of the known ones by default.')
+
+    def handle(self, *args, **options):
+        providers = options['providers'] or sorted(
+            set(NotificationProvider.objects.values_list('name', flat=True)) |
+            set(getattr(settings, 'MOBILEAPPS_NOTIFICATION_RATE_LIMITS', {}))
+        )
+        for provider in providers:
+            metrics = get_rate_limit_metrics(provider)
+            self.stdout.write('{}: {}'.format(
+                provider, ', '.join('{} {}'.format(metrics[event], event) for event in EVENTS),
+            ))
@@ -0,0 +1,21 @@
+"""
+Management command to apply the retention policy to the mobile app history.
+"""
+from django.core.management.base import BaseCommand
+from mobileapps.retention import prune_mobile_app_history
+
+
+class Command(BaseCommand):
+    """
+    Compacts and expires MobileAppHistory records, see `mobileapps.retention`.
+    """
+    help = 'Compacts and expires mobile app history according to MOBILEAPPS_HISTORY_RETENTION.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Records deleted per statement.')
+
+    def handle(self, *args, **options):
+        result = prune_mobile_app_history(batch_size=options['batch_size'])
+        self.stdout.write('Removed {} history records ({} compacted, {} expired) in {:.1f}s'.format(
+            result['compacted'] + result['dropped'], result['compacted'], result['dropped'], result['seconds'],
+        ))
@@ -0,0 +1,194 @@
+"""
+Management command to re-encrypt the provider credentials of mobile apps and their history.
+
+Rotating the StringCipher key:
+
+    1. Deploy the new key, keeping a cipher configured with the old key importable.
+    2. Run this command with `--old-cipher` pointing at that cipher.
+
+Rows are decrypted with the old cipher and encrypted again with the current one.
+Values the current cipher can already decrypt are left as they are, so rows saved
+while the command runs, and chunks written before an interrupted run could record
+them in its checkpoint, are never decrypted with the old cipher.
+"""
+import json
+import logging
+import os
+import time
+from bisect import bisect_right
+from multiprocessing import Pool
+
+from cryptography.fernet import InvalidToken
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+from edx_solutions_api_integration.utils import StringCipher
+from mobileapps.caching import bump_generations, get_mobile_app_generation_name
+from mobileapps.models import (EncryptedCharField, EncryptedValue, MobileApp,
+                               decrypt_value)
+
+log = logging.getLogger(__name__)
+
+ENCRYPTED_FIELDS = ('provider_key', 'provider_secret')
+MODEL_LABELS = ('mobileapps.MobileApp', 'mobileapps.MobileAppHistory')
+
+
+def _decrypt(old_cipher, value):
+    """
+    Returns the plaintext of a loaded column value, and whether it must be written
+    again, i.e. whether it isn't encrypted with the current cipher yet.
+    """
+    if not isinstance(value, EncryptedValue):
+        return value, bool(value)
+    ciphertext = value.ciphertext[len(EncryptedCharField.prefix):].encode()
+    try:
+        return StringCipher.decrypt(ciphertext).decode('utf-8'), False
+    except (InvalidToken, ValueError):
+        return old_cipher.decrypt(ciphertext).decode('utf-8'), True
+
+
+def reencrypt_chunk(args):
+    """
+    Re-encrypts all rows of a model with primary keys between `first_pk` and `last_pk`.
+
+    Module level so that it can be handed to worker processes.
+    """
+    model_label, first_pk, last_pk, old_cipher_path, batch_size = args
+    model = apps.get_model(model_label)
+    old_cipher = import_string(old_cipher_path)
+
+    # A chunk is written completely or not at all, so it can be checkpointed as a unit. Its rows
+    # are locked while they are read, so that values saved meanwhile aren't overwritten with older ones.
+    with transaction.atomic():
+        rows = model.objects.select_for_update().filter(
+            pk__gte=first_pk, pk__lte=last_pk,
+        ).values_list('pk', *ENCRYPTED_FIELDS)
+        objects = []
+        for row in rows.iterator():
+            obj, stale = model(pk=row[0]), False
+            for field_name, value in zip(ENCRYPTED_FIELDS, row[1:]):
+                plaintext, field_stale = _decrypt(old_cipher, value)
+                setattr(obj, field_name, plaintext)
+                stale = stale or field_stale
+            if stale:
+                objects.append(obj)
+        model.objects.bulk_update(objects, ENCRYPTED_FIELDS, batch_size=batch_size)
+    if model is MobileApp:
+        # bulk_update sends no signals, so cached details of the apps are discarded here.
+        bump_generations([get_mobile_app_generation_name(obj.pk) for obj in objects])
+    return model_label, first_pk, last_pk, len(objects)
+
+
+class Checkpoint:
+    """
+    Primary key ranges already re-encrypted per model, persisted as JSON.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.ranges = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.ranges = json.load(checkpoint_file)
+        for model_ranges in self.ranges.values():
+            model_ranges.sort()
+
+    def is_done(self, model_label, pk):
+        model_ranges = self.ranges.get(model_label, [])
+        index = bisect_right(model_ranges, [pk, float('inf')]) - 1
+        return index >= 0 and model_ranges[index][0] <= pk <= model_ranges[index][1]
+
+    def mark_done(self, model_label, first_pk, last_pk):
+        model_ranges = self.ranges.setdefault(model_label, [])
+        model_ranges.append([first_pk, last_pk])
+        model_ranges.sort()
+        if self.path:
+            temp_path = '{}.tmp'.format(self.path)
+            with open(temp_path, 'w') as checkpoint_file:
+                json.dump(self.ranges, checkpoint_file)
+            os.replace(temp_path, self.path)
+
+
+def iter_chunks(model_label, checkpoint, chunk_size):
+    """
+    Walks a model's primary keys with a server-side iterator and yields ranges of
+    at most `chunk_size` rows that have not been re-encrypted yet.
+    """
+    model = apps.get_model(model_label)
+    # Rows created after the walk started are already encrypted with the current key.
+    max_pk = model.objects.order_by('-pk').values_list('pk', flat=True).first()
+    pks = model.objects.filter(pk__lte=max_pk or 0).order_by('pk').values_list('pk', flat=True)
+
+    chunk = []
+    for pk in pks.iterator(chunk_size=chunk_size):
+        if checkpoint.is_done(model_label, pk):
+            # Never let a range span rows which were already processed.
+            if chunk:
+                yield chunk[0], chunk[-1]
+                chunk = []
+            continue
+        chunk.append(pk)
+        if len(chunk) == chunk_size:
+            yield chunk[0], chunk[-1]
+            chunk = []
+    if chunk:
+        yield chunk[0], chunk[-1]
+
+
+class Command(BaseCommand):
+    """
+    Re-encrypts `provider_key` and `provider_secret` of MobileApp and MobileAppHistory.
+    """
+    help = 'Re-encrypts mobile app provider credentials, e.g. after rotating the cipher key.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--old-cipher',
+            default='edx_solutions_api_integration.utils.StringCipher',
+            help='Dotted path to the cipher, with a decrypt() method, the values are currently encrypted with.',
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows per primary key chunk.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per bulk_update statement.')
+        parser.add_argument('--workers', type=int, default=1, help='Number of parallel worker processes.')
+        parser.add_argument(
+            '--checkpoint',
+            default=None,
+            help='Path of a file recording finished chunks, used to resume an interrupted run.',
+        )
+
+    def handle(self, *args, **options):
+        checkpoint = Checkpoint(options['checkpoint'])
+        workers = options['workers']
+
+        pool = None
+        if workers > 1:
+            # Forked workers must open their own database connections.
+            connections.close_all()
+            pool = Pool(workers)
+
+        try:
+            for model_label in MODEL_LABELS:
+                start = time.time()
+                # Chunks are collected upfront, so the checkpoint is not read while it's being written.
+                tasks = [
+                    (model_label, first_pk, last_pk, options['old_cipher'], options['batch_size'])
+                    for first_pk, last_pk in iter_chunks(model_label, checkpoint, options['chunk_size'])
+                ]
+                results = pool.imap_unordered(reencrypt_chunk, tasks) if pool else map(reencrypt_chunk, tasks)
+
+                total = 0
+                for _, first_pk, last_pk, count in results:
+                    checkpoint.mark_done(model_label, first_pk, last_pk)
+                    total += count
+                    log.info('%s: re-encrypted rows %s to %s', model_label, first_pk, last_pk)
+
+                elapsed = time.time() - start
+                self.stdout.write('{}: re-encrypted {} rows in {:.1f}s ({:.0f} rows/s)'.format(
+                    model_label, total, elapsed, total / elapsed if elapsed else 0,
+                ))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        decrypt_value.cache_clear()
@@ -0,0 +1,269 @@
+"""
+Set based writes of mobile app memberships.
+
+Memberships are written straight to the through tables in chunks, instead of one
+related manager call per member. The `m2m_changed` signals are still sent, once
+per chunk.
+"""
+import codecs
+import csv
+import json
+import uuid
+from contextlib import contextmanager
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.db.models.signals import m2m_changed
+from mobileapps.models import MobileApp
+
+# Keys looked up in NDJSON objects, and header cells skipped in the first row of CSV files, of user imports.
+USER_IDENTIFIER_KEYS = ('id', 'user_id', 'username', 'email')
+
+
+def get_membership_chunk_size():
+    """
+    Returns the number of members written per statement.
+    """
+    return getattr(settings, 'MOBILEAPPS_MEMBERSHIP_CHUNK_SIZE', 1000)
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of at most `size` items of an iterable.
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def iter_keyset_batches(queryset, field, size, after=None):
+    """
+    Yields lists of at most `size` values of `field` of a queryset greater than `after`,
+    in increasing order.
+
+    Each list is read by its own query starting after the last value of the previous
+    one, so neither the database nor the caller holds more than one list at a time.
+    """
+    queryset = queryset.order_by(field).values_list(field, flat=True)
+    if after is not None:
+        queryset = queryset.filter(**{'{}__gt'.format(field): after})
+    batch = list(queryset[:size])
+    while batch:
+        yield batch
+        batch = list(queryset.filter(**{'{}__gt'.format(field): batch[-1]})[:size])
+
+
+def _send_m2m_changed(mobile_app, field, action, pk_set, using):
+    m2m_changed.send(
+        sender=field.remote_field.through, action=action, instance=mobile_app, reverse=False,
+        model=field.related_model, pk_set=pk_set, using=using,
+    )
+
+
+def add_members(mobile_app, relation, ids):
+    """
+    Adds the objects among `ids` which exist to the `relation` ('users' or
+    'organizations') of a mobile app, ignoring those which are members already.
+
+    Returns the number of members added.
+    """
+    field = MobileApp._meta.get_field(relation)
+    through = field.remote_field.through
+    using = router.db_for_write(through, instance=mobile_app)
+    source, target = '{}_id'.format(field.m2m_field_name()), '{}_id'.format(field.m2m_reverse_field_name())
+
+    added = 0
+    for chunk in chunked(ids, get_membership_chunk_size()):
+        with transaction.atomic(using=using):
+            # Like the related managers, only the new members are reported to `m2m_changed`.
+            pk_set = set(field.related_model.objects.using(using).filter(pk__in=chunk).values_list('pk', flat=True))
+            pk_set -= set(
+                through.objects.using(using).filter(**{source: mobile_app.pk, '{}__in'.format(target): pk_set})
+                .values_list(target, flat=True)
+            )
+            if not pk_set:
+                continue
+
+            _send_m2m_changed(mobile_app, field, 'pre_add', pk_set, using)
+            through.objects.using(using).bulk_create(
+                [through(**{source: mobile_app.pk, target: pk}) for pk in pk_set],
+                ignore_conflicts=True,
+            )
+            _send_m2m_changed(mobile_app, field, 'post_add', pk_set, using)
+        added += len(pk_set)
+    return added
+
+
+def remove_members(mobile_app, relation, ids):
+    """
+    Removes the objects among `ids` from the `relation` ('users' or 'organizations') of a mobile app.
+
+    Returns the number of memberships removed.
+    """
+    field = MobileApp._meta.get_field(relation)
+    through = field.remote_field.through
+    using = router.db_for_write(through, instance=mobile_app)
+    source, target = '{}_id'.format(field.m2m_field_name()), '{}__in'.format(field.m2m_reverse_field_name())
+
+    removed = 0
+    for chunk in chunked(ids, get_membership_chunk_size()):
+        pk_set = set(chunk)
+        _send_m2m_changed(mobile_app, field, 'pre_remove', pk_set, using)
+        removed += through.objects.using(using).filter(**{source: mobile_app.pk, target: chunk}).delete()[0]
+        _send_m2m_changed(mobile_app, field, 'post_remove', pk_set, using)
+    return removed
+
+
+def _iter_id_batches(cursor, sql, params, size):
+    """
+    Yields lists of at most `size` ids read by `sql`, in increasing order.
+
+    `sql` selects one id column and ends with placeholders for the id to read
+    after and for `size`, so each list is read by its own query.
+    """
+    after = 0
+    while True:
+        cursor.execute(sql, params + [after, size])
+        batch = [row[0] for row in cursor.fetchall()]
+        if not batch:
+            return
+        yield batch
+        after = batch[-1]
+
+
+@contextmanager
+def id_table(ids, using, size):
+    """
+    Loads `ids` in chunks into a temporary table and yields its quoted name.
+    The table is dropped on exit.
+    """
+    connection = connections[using]
+    table = connection.ops.quote_name('mobileapps_ids_{}'.format(uuid.uuid4().hex))
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE {} (id BIGINT NOT NULL PRIMARY KEY)'.format(table))
+        try:
+            for chunk in chunked(ids, size):
+                cursor.executemany('INSERT INTO {} (id) VALUES (%s)'.format(table), [(pk, ) for pk in chunk])
+            yield table
+        finally:
+            cursor.execute('DROP TABLE {}'.format(table))
+
+
+def sync_members(mobile_app, relation, ids):
+    """
+    Makes the `relation` ('users' or 'organizations') of a mobile app consist of
+    exactly the objects among `ids` which exist, in one transaction.
+
+    `ids` are loaded once, in chunks, into a temporary table, and the memberships
+    to remove and the members to add are read in keyset batches by anti-joins
+    against it, so neither the statements nor memory grow with the number of
+    members. Returns the number of memberships added and removed.
+    """
+    field = MobileApp._meta.get_field(relation)
+    through = field.remote_field.through
+    using = router.db_for_write(through, instance=mobile_app)
+    quote_name = connections[using].ops.quote_name
+    source = quote_name(through._meta.get_field(field.m2m_field_name()).column)
+    target = quote_name(through._meta.get_field(field.m2m_reverse_field_name()).column)
+    related = field.related_model._meta
+    size = get_membership_chunk_size()
+
+    desired = {int(pk) for pk in ids}
+    with id_table(sorted(desired), using, size) as table, transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            stale = (
+                'SELECT m.{target} FROM {through} m LEFT JOIN {table} d ON d.id = m.{target} '
+                'WHERE m.{source} = %s AND d.id IS NULL AND m.{target} > %s ORDER BY m.{target} LIMIT %s'
+            ).format(target=target, source=source, through=quote_name(through._meta.db_table), table=table)
+            removed = 0
+            for chunk in _iter_id_batches(cursor, stale, [mobile_app.pk], size):
+                removed += remove_members(mobile_app, relation, chunk)
+
+            missing = (
+                'SELECT d.id FROM {table} d INNER JOIN {related} r ON r.{pk} = d.id '
+                'LEFT JOIN {through} m ON m.{target} = d.id AND m.{source} = %s '
+                'WHERE m.{target} IS NULL AND d.id > %s ORDER BY d.id LIMIT %s'
+            ).format(
+                table=table, related=quote_name(related.db_table), pk=quote_name(related.pk.column),
+                through=quote_name(through._meta.db_table), target=target, source=source,
+            )
+            added = 0
+            for chunk in _iter_id_batches(cursor, missing, [mobile_app.pk], size):
+                added += add_members(mobile_app, relation, chunk)
+    return added, removed
+
+
+def get_member_ids(mobile_app, relation, ids):
+    """
+    Returns the distinct ids among `ids` of the members of the `relation` ('users'
+    or 'organizations') of a mobile app, in increasing order, read in one query.
+    """
+    field = MobileApp._meta.get_field(relation)
+    through = field.remote_field.through
+    source, target = '{}_id'.format(field.m2m_field_name()), '{}_id'.format(field.m2m_reverse_field_name())
+
+    ids = {int(pk) for pk in ids}
+    if not ids:
+        return []
+    return list(
+        through.objects.filter(**{source: mobile_app.pk, '{}__in'.format(target): ids})
+        .order_by(target).values_list(target, flat=True)
+    )
+
+
+def read_user_identifiers(import_file, file_format):
+    """
+    Yields the user identifiers listed in a binary CSV file (first column, below an
+    optional header row) or NDJSON file (one id, username or email per line, either
+    as a plain value or as an object with one of `USER_IDENTIFIER_KEYS`). Unreadable
+    lines yield None.
+    """
+    lines = codecs.iterdecode(import_file, 'utf-8-sig')
+    if file_format == 'csv':
+        for number, row in enumerate(csv.reader(lines)):
+            identifier = row[0].strip() if row else ''
+            if not identifier or (number == 0 and identifier.lower() in USER_IDENTIFIER_KEYS + ('user', )):
+                continue
+            yield identifier
+        return
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            value = None
+        if isinstance(value, dict):
+            value = next((value[key] for key in USER_IDENTIFIER_KEYS if value.get(key)), None)
+        yield value
+
+
+def resolve_user_identifiers(identifiers):
+    """
+    Resolves user ids, usernames and emails to user ids, with one query per kind.
+
+    All-digit identifiers are taken as ids, or as usernames when no user has that
+    id, and identifiers containing '@' as emails. Returns the set of user ids found
+    and the number of identifiers not found.
+    """
+    identifiers = ['' if identifier is None else str(identifier).strip() for identifier in identifiers]
+    ids = {identifier for identifier in identifiers if identifier.isdigit()}
+    emails = {identifier for identifier in identifiers if '@' in identifier}
+    usernames = set(identifiers) - ids - emails - {''}
+
+    resolved = {}
+    if ids:
+        resolved.update((str(pk), pk) for pk in User.objects.filter(id__in=ids).values_list('id', flat=True))
+        usernames |= ids - set(resolved)
+    if usernames:
+        resolved.update(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    if emails:
+        resolved.update(User.objects.filter(email__in=emails).values_list('email', 'id'))
+
+    user_ids = {resolved[identifier] for identifier in identifiers if identifier in resolved}
+    return user_ids, len([identifier for identifier in identifiers if identifier not in resolved])
@@ -0,0 +1,21 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mobileapps', '0006_auto_20171229_0720'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mobileapphistory',
+            name='mobile_app',
+            field=models.ForeignKey(related_name='history', on_delete=django.db.models.deletion.SET_NULL, blank=True, to='mobileapps.MobileApp', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='mobileapphistory',
+            index=models.Index(fields=['mobile_app', 'created'], name='mobileapp_history_app_created'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+# History rows are matched to their app by these identifiers.
+MATCH_FIELDS = ('ios_app_id', 'android_app_id', 'ios_bundle_id')
+
+
+def backfill_mobile_app(apps, schema_editor):
+    """
+    Links existing history rows to their mobile app, one primary key batch per transaction.
+
+    A row is linked to an app when that app, and no other, has the values of all its
+    identifiers found on apps. Rows matching several apps, or none, are left unlinked
+    and counted; names are never matched, since apps may share them.
+    """
+    MobileApp = apps.get_model('mobileapps', 'MobileApp')
+    MobileAppHistory = apps.get_model('mobileapps', 'MobileAppHistory')
+
+    apps_by_value = {field: defaultdict(set) for field in MATCH_FIELDS}
+    for app in MobileApp.objects.values('id', *MATCH_FIELDS).iterator():
+        for field in MATCH_FIELDS:
+            if app[field]:
+                apps_by_value[field][app[field]].add(app['id'])
+
+    counts = {'linked': 0, 'ambiguous': 0, 'unmatched': 0}
+    last_pk = 0
+    while True:
+        rows = list(
+            MobileAppHistory.objects.filter(pk__gt=last_pk, mobile_app__isnull=True).order_by('pk').values(
+                'id', *MATCH_FIELDS
+            )[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+
+        history_ids = defaultdict(list)
+        for row in rows:
+            matches = [apps_by_value[field][row[field]] for field in MATCH_FIELDS if row[field] in apps_by_value[field]]
+            candidates = set.intersection(*matches) if matches else set()
+            if len(candidates) == 1:
+                history_ids[candidates.pop()].append(row['id'])
+                counts['linked'] += 1
+            elif matches:
+                counts['ambiguous'] += 1
+            else:
+                counts['unmatched'] += 1
+
+        with transaction.atomic():
+            for app_id, ids in history_ids.items():
+                MobileAppHistory.objects.filter(pk__in=ids).update(mobile_app_id=app_id)
+        last_pk = rows[-1]['id']
+
+    print(
+        '\n  Linked {linked} history rows to their mobile app, left {ambiguous} matching several apps '
+        'and {unmatched} matching none unlinked.'.format(**counts)
+    )
+
+
+class Migration(migrations.Migration):
+
+    # Every batch is committed on its own, so the table is never locked as a whole.
+    atomic = False
+
+    dependencies = [
+        ('mobileapps', '0007_mobileapphistory_mobile_app'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_mobile_app, migrations.RunPython.noop),
+    ]
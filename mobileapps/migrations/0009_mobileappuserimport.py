@@ -0,0 +1,36 @@
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mobileapps', '0008_backfill_mobileapphistory_mobile_app'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MobileAppUserImport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_format', models.CharField(max_length=16, choices=[('csv', 'CSV'), ('ndjson', 'NDJSON')])),
+                ('status', models.CharField(default='pending', max_length=16, choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')])),
+                ('processed_count', models.PositiveIntegerField(default=0)),
+                ('failed_count', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+                ('finished_at', models.DateTimeField(null=True, blank=True)),
+                ('created_by', models.ForeignKey(to=settings.AUTH_USER_MODEL, on_delete=django.db.models.deletion.PROTECT)),
+                ('mobile_app', models.ForeignKey(related_name='user_imports', to='mobileapps.MobileApp', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
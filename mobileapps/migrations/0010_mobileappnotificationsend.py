@@ -0,0 +1,34 @@
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edx_solutions_organizations', '0002_remove_organization_workgroups'),
+        ('mobileapps', '0009_mobileappuserimport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MobileAppNotificationSend',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, verbose_name='created', editable=False)),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, verbose_name='modified', editable=False)),
+                ('payload', models.TextField()),
+                ('status', models.CharField(default='pending', max_length=16, choices=[('pending', 'Pending'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')])),
+                ('last_user_id', models.PositiveIntegerField(null=True, blank=True)),
+                ('recipient_count', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+                ('finished_at', models.DateTimeField(null=True, blank=True)),
+                ('mobile_app', models.ForeignKey(related_name='notification_sends', to='mobileapps.MobileApp', on_delete=django.db.models.deletion.CASCADE)),
+                ('organization', models.ForeignKey(related_name='mobile_app_notification_sends', to='edx_solutions_organizations.Organization', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -1,13 +1,25 @@
 """
 Django database models supporting the mobile apps
 """
+import json
+import threading
+from functools import lru_cache
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from edx_solutions_api_integration.utils import StringCipher
 from edx_solutions_organizations.models import Organization
+from mobileapps.caching import (MOBILE_APPS_GENERATION,
+                                bump_generations_on_commit,
+                                get_mobile_app_generation_name,
+                                get_user_organizations_generation_name)
 from mobileapps.image_helpers import get_image_names, remove_images
 from model_utils.fields import AutoCreatedField
 from model_utils.models import TimeStampedModel
@@ -19,16 +31,107 @@ DEPLOYMENT_CHOICES = (
     (4, 'Other'),
 )
 
+# Number of distinct ciphertexts each worker process keeps decrypted in memory.
+DECRYPTION_CACHE_SIZE = getattr(settings, 'MOBILEAPPS_DECRYPTION_CACHE_SIZE', 1024)
+
+
+@lru_cache(maxsize=DECRYPTION_CACHE_SIZE)
+def decrypt_value(ciphertext):
+    """
+    Decrypts a ciphertext stored by `EncryptedCharField` (without its prefix).
+
+    Results are memoized per process, so identical ciphertexts are only decrypted
+    once; use `decrypt_value.cache_info()` for hit/miss counters and
+    `decrypt_value.cache_clear()` after a key rotation.
+    """
+    return StringCipher.decrypt(ciphertext.encode()).decode('utf-8')
+
+
+class EncryptedValue:
+    """
+    A value loaded from an `EncryptedCharField` column.
+
+    The ciphertext is only decrypted the first time the plaintext is needed,
+    after which the plaintext is kept on the object.
+    """
+    __slots__ = ('ciphertext', '_plaintext')
+
+    def __init__(self, ciphertext, plaintext=None):
+        self.ciphertext = ciphertext
+        self._plaintext = plaintext
+
+    @property
+    def plaintext(self):
+        if self._plaintext is None:
+            self._plaintext = decrypt_value(self.ciphertext[len(EncryptedCharField.prefix):])
+        return self._plaintext
+
+    def __str__(self):
+        return self.plaintext
+
+    def __repr__(self):
+        return '<EncryptedValue: {}>'.format(self.ciphertext)
+
+    def __eq__(self, other):
+        if isinstance(other, EncryptedValue):
+            return self.ciphertext == other.ciphertext or self.plaintext == other.plaintext
+        return self.plaintext == other
+
+    def __hash__(self):
+        return hash(self.plaintext)
+
+
+class EncryptedValueAttribute(DeferredAttribute):
+    """
+    Model attribute of an `EncryptedCharField`, which keeps the `EncryptedValue`
+    on the instance and hands out its plaintext when read.
+    """
+    def __get__(self, instance, cls=None):
+        value = super().__get__(instance, cls)
+        if isinstance(value, EncryptedValue):
+            return value.plaintext
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field_name] = value
+
 
 class EncryptedCharField(models.CharField):
     prefix = 'enc_str__'
 
+    def contribute_to_class(self, cls, name, **kwargs):
+        super().contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, EncryptedValueAttribute(self.attname))
+
     def from_db_value(self, value, expression, connection, context):
         if value and value.startswith(self.prefix):
-            value = StringCipher.decrypt(value[len(self.prefix):].encode())
-        return value.decode('utf-8') if value else None
+            return EncryptedValue(value)
+        return value or None
+
+    def get_stored_value(self, model_instance):
+        """
+        Returns the value held by the instance without decrypting it, i.e. an
+        `EncryptedValue` once the instance has been loaded or saved.
+        """
+        if self.attname in model_instance.__dict__:
+            return model_instance.__dict__[self.attname]
+        return getattr(model_instance, self.attname)
+
+    def pre_save(self, model_instance, add):
+        # Unchanged values are passed through as is, so they are never decrypted. New
+        # values are encrypted once and kept, so copies of them can reuse the ciphertext.
+        value = self.get_stored_value(model_instance)
+        if value and not isinstance(value, EncryptedValue):
+            if value.startswith(self.prefix):
+                value = EncryptedValue(value)
+            else:
+                value = EncryptedValue(self.prefix + StringCipher.encrypt(value), plaintext=value)
+            model_instance.__dict__[self.attname] = value
+        return value
 
     def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, EncryptedValue):
+            return value.ciphertext
         if value and not value.startswith(self.prefix):
             value = self.prefix + StringCipher.encrypt(value)
         return value
@@ -45,6 +148,28 @@ class NotificationProvider(TimeStampedModel):
         return self.name
 
 
+class MobileAppQuerySet(models.QuerySet):
+    """
+    Queries on mobile apps.
+    """
+    def with_member_counts(self):
+        """
+        Annotates each app with `user_count` and `organization_count`.
+
+        Counted by subqueries rather than joins, so the two relations don't multiply each other.
+        """
+        def count(through):
+            counts = through.objects.filter(mobileapp_id=OuterRef('pk')).values('mobileapp_id').annotate(
+                count=Count('*')
+            ).values('count')
+            return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+        return self.annotate(
+            user_count=count(MobileApp.users.through),
+            organization_count=count(MobileApp.organizations.through),
+        )
+
+
 class MobileApp(TimeStampedModel):
     """
     A django model to track mobile apps.
@@ -67,6 +192,49 @@ class MobileApp(TimeStampedModel):
     users = models.ManyToManyField(User, related_name="mobile_apps", blank=True)
     organizations = models.ManyToManyField(Organization, related_name="mobile_apps", blank=True)
 
+    objects = MobileAppQuerySet.as_manager()
+
+    # Fields copied into MobileAppHistory; a save only records history when one of them changed.
+    HISTORY_FIELDS = (
+        'name', 'ios_app_id', 'ios_bundle_id', 'android_app_id', 'ios_download_url', 'android_download_url',
+        'deployment_mechanism', 'analytics_url', 'notification_provider', 'provider_key', 'provider_secret',
+        'provider_dashboard_url', 'current_version', 'is_active',
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.track_history_fields()
+        return instance
+
+    def _get_history_values(self):
+        """
+        Returns the loaded values of the history fields keyed by attname, encrypted
+        values are returned as stored so that they are not decrypted.
+        """
+        values = {}
+        for name in self.HISTORY_FIELDS:
+            attname = self._meta.get_field(name).attname
+            if attname in self.__dict__:
+                values[attname] = self.__dict__[attname]
+        return values
+
+    def track_history_fields(self):
+        """
+        Remembers the current values of the history fields, to detect later changes.
+        """
+        self._tracked_history_values = self._get_history_values()
+
+    def get_changed_history_fields(self):
+        """
+        Returns the attnames of the history fields changed since the app was loaded or last saved.
+        """
+        tracked = getattr(self, '_tracked_history_values', {})
+        return [
+            attname for attname, value in self._get_history_values().items()
+            if attname not in tracked or tracked[attname] != value
+        ]
+
     @property
     def deployment_mechanism_choice_text(self):
         return dict(DEPLOYMENT_CHOICES)[self.deployment_mechanism]
@@ -88,6 +256,32 @@ class MobileApp(TimeStampedModel):
         return None
 
 
+class MobileAppHistoryQuerySet(models.QuerySet):
+    """
+    Queries reconstructing mobile app configurations from their history.
+    """
+    def _latest_as_of(self, timestamp):
+        return self.filter(created__lte=timestamp).order_by('-created', '-id')
+
+    def snapshot(self, mobile_app_id, timestamp):
+        """
+        Returns the history record describing a mobile app at the given time, or None.
+        """
+        return self._latest_as_of(timestamp).filter(mobile_app_id=mobile_app_id).first()
+
+    def as_of(self, timestamp):
+        """
+        Returns the history records describing every mobile app at the given time.
+
+        Runs as a single query with one indexed seek per app. Window functions would
+        need MySQL 8, and Django can't filter on them yet.
+        """
+        latest = self._latest_as_of(timestamp).filter(mobile_app=OuterRef('pk')).values('id')[:1]
+        return self.filter(
+            id__in=MobileApp.objects.annotate(snapshot_id=Subquery(latest)).values('snapshot_id')
+        )
+
+
 class MobileAppHistory(models.Model):
     """
     A django model to track changes in mobile app model.
@@ -107,16 +301,107 @@ class MobileAppHistory(models.Model):
     current_version = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     updated_by = models.ForeignKey(User, on_delete=models.PROTECT)
+    mobile_app = models.ForeignKey(MobileApp, related_name="history", blank=True, null=True,
+                                   on_delete=models.SET_NULL)
     created = AutoCreatedField()
 
+    objects = MobileAppHistoryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['mobile_app', 'created'], name='mobileapp_history_app_created'),
+        ]
+
+
+class MobileAppHistoryBuffer(threading.local):
+    """
+    Collects the history records of a transaction and writes them in one go once it commits.
+
+    Records are inserted with a single `bulk_create`, or handed to a Celery task
+    when `MOBILEAPPS_HISTORY_ASYNC` is enabled. Outside of a transaction they are
+    written immediately.
+
+    Each connection has one buffer of records, in the order they were made, tagged
+    with the savepoints open at the time. Every record registers a commit hook,
+    which Django drops when one of those savepoints or the transaction is rolled
+    back, so the records of rolled back savepoints are never marked as committed.
+    A hook followed by the record of one made within the same savepoints or fewer
+    leaves the write to it, since that hook runs as well; any other hook writes the
+    committed records up to its own, in order.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def add(self, record, using):
+        if transaction.get_autocommit(using):
+            self.write([record], using)
+            return
+
+        connection = transaction.get_connection(using)
+        # Savepoint ids are never reused, so equal tags mean the same savepoints.
+        savepoints = frozenset(sid for sid in connection.savepoint_ids if sid)
+        buffer = self.buffers.setdefault(using, {'start': 0, 'entries': []})
+        position = buffer['start'] + len(buffer['entries'])
+        buffer['entries'].append({'record': record, 'savepoints': savepoints, 'committed': False})
+        transaction.on_commit(lambda: self.commit(using, position), using=using)
+
+    def commit(self, using, position):
+        buffer = self.buffers[using]
+        index = position - buffer['start']
+        entries = buffer['entries']
+        entries[index]['committed'] = True
+        savepoints = entries[index]['savepoints']
+        if any(entry['savepoints'] <= savepoints for entry in entries[index + 1:]):
+            return
+
+        # Records up to this one whose hooks did not run were rolled back.
+        records = [entry['record'] for entry in entries[:index + 1] if entry['committed']]
+        del entries[:index + 1]
+        buffer['start'] = position + 1
+        if records:
+            self.write(records, using)
+
+    def write(self, records, using):
+        if getattr(settings, 'MOBILEAPPS_HISTORY_ASYNC', False):
+            from mobileapps.tasks import record_mobile_app_history_task  # pylint: disable=cyclic-import
+            record_mobile_app_history_task.delay([self.serialize(record) for record in records])
+        else:
+            MobileAppHistory.objects.using(using).bulk_create(records)
+
+    @staticmethod
+    def serialize(record):
+        """
+        Returns the field values of a history record keyed by attname, keeping encrypted
+        fields as their ciphertext.
+        """
+        data = {}
+        for field in MobileAppHistory._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            if isinstance(field, EncryptedCharField):
+                value = field.get_stored_value(record)
+                data[field.attname] = value.ciphertext if isinstance(value, EncryptedValue) else value
+            else:
+                data[field.attname] = getattr(record, field.attname)
+        return data
+
+
+mobile_app_history_buffer = MobileAppHistoryBuffer()
+
 
 @receiver(post_save, sender=MobileApp)
 def user_post_save_callback(sender, **kwargs):
     """
-    Save mobile app history after saving the mobile app data.
+    Save mobile app history after saving the mobile app data, if any of its history fields changed.
+
+    The history record is written when the surrounding transaction commits.
     """
     mobile_app = kwargs['instance']
+    if not kwargs['created'] and not mobile_app.get_changed_history_fields():
+        return
+
     mobile_app_history = MobileAppHistory()
+    mobile_app_history.mobile_app_id = mobile_app.id
     mobile_app_history.name = mobile_app.name
     mobile_app_history.ios_app_id = mobile_app.ios_app_id
     mobile_app_history.ios_bundle_id = mobile_app.ios_bundle_id
@@ -125,14 +410,65 @@ def user_post_save_callback(sender, **kwargs):
     mobile_app_history.android_download_url = mobile_app.android_download_url
     mobile_app_history.deployment_mechanism = mobile_app.deployment_mechanism
     mobile_app_history.analytics_url = mobile_app.analytics_url
-    mobile_app_history.notification_provider = mobile_app.notification_provider
-    mobile_app_history.provider_key = mobile_app.provider_key
-    mobile_app_history.provider_secret = mobile_app.provider_secret
+    mobile_app_history.notification_provider_id = mobile_app.notification_provider_id
+    # Reuse the ciphertexts just written for the app rather than encrypting again.
+    mobile_app_history.provider_key = MobileApp._meta.get_field('provider_key').get_stored_value(mobile_app)
+    mobile_app_history.provider_secret = MobileApp._meta.get_field('provider_secret').get_stored_value(mobile_app)
     mobile_app_history.provider_dashboard_url = mobile_app.provider_dashboard_url
     mobile_app_history.current_version = mobile_app.current_version
     mobile_app_history.is_active = mobile_app.is_active
-    mobile_app_history.updated_by = mobile_app.updated_by
-    mobile_app_history.save()
+    mobile_app_history.updated_by_id = mobile_app.updated_by_id
+    mobile_app_history_buffer.add(mobile_app_history, kwargs['using'])
+    mobile_app.track_history_fields()
+
+
+@receiver(post_save, sender=MobileApp)
+@receiver(post_delete, sender=MobileApp)
+def mobile_app_changed_callback(sender, instance, using, **kwargs):
+    """
+    Bumps the generation counter of a mobile app saved or deleted, discarding its cached details.
+    """
+    bump_generations_on_commit([get_mobile_app_generation_name(instance.pk)], using)
+
+
+@receiver(m2m_changed, sender=MobileApp.users.through)
+@receiver(m2m_changed, sender=MobileApp.organizations.through)
+def mobile_app_members_changed_callback(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """
+    Bumps the generation counters of the mobile apps whose users or organizations changed.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        mobile_app_ids = [instance.pk]
+    elif action == 'pre_clear':
+        mobile_app_ids = list(instance.mobile_apps.values_list('id', flat=True))
+    else:
+        mobile_app_ids = list(pk_set)
+
+    names = [MOBILE_APPS_GENERATION] + [get_mobile_app_generation_name(pk) for pk in mobile_app_ids]
+    bump_generations_on_commit(names, using)
+
+
+@receiver(m2m_changed, sender=Organization.users.through)
+def organization_users_changed_callback(sender, instance, action, reverse, pk_set, using, **kwargs):
+    """
+    Bumps the generation counters of the users whose organizations changed, which scope
+    what non-staff users see.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':
+        user_ids = list(instance.users.values_list('id', flat=True))
+    else:
+        user_ids = list(pk_set)
+
+    names = [get_user_organizations_generation_name(pk) for pk in user_ids]
+    bump_generations_on_commit(names, using)
 
 
 class Theme(TimeStampedModel):
@@ -163,7 +499,7 @@ class Theme(TimeStampedModel):
         try:
             theme = Theme.objects.get(organization_id=organization_id, active=True)
             theme.active = None
-            theme.save(update_fields=['active'])
+            theme.save(update_fields=['active', 'modified'])
         except Theme.DoesNotExist:
             pass
 
@@ -186,3 +522,78 @@ class Theme(TimeStampedModel):
         remove_images(settings.ORGANIZATION_LOGO_IMAGE_BACKEND, image_names)
         self.header_bg_image_uploaded_at = None
         self.save(update_fields=['header_bg_image_uploaded_at', 'modified'])
+
+
+class MobileAppUserImport(TimeStampedModel):
+    """
+    A django model to track bulk imports of users into a mobile app.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    )
+    FORMAT_CHOICES = (
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    )
+
+    mobile_app = models.ForeignKey(MobileApp, related_name="user_imports", on_delete=models.CASCADE)
+    created_by = models.ForeignKey(User, on_delete=models.PROTECT)
+    file_name = models.CharField(max_length=255)
+    file_format = models.CharField(max_length=16, choices=FORMAT_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    processed_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    @property
+    def throughput(self):
+        """
+        Returns the number of identifiers processed per second, or None before the import started.
+        """
+        if not self.started_at:
+            return None
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return self.processed_count / elapsed if elapsed > 0 else None
+
+
+class MobileAppNotificationSend(TimeStampedModel):
+    """
+    A django model to track the send of a notification to all the users of an organization.
+
+    The last user id dispatched is checkpointed as the send progresses, so that an
+    interrupted send resumes after it instead of starting over. It records which
+    batches were queued, not which were published: a completed send has queued all
+    of them, and the batch tasks publish them afterwards.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    )
+
+    mobile_app = models.ForeignKey(MobileApp, related_name="notification_sends", on_delete=models.CASCADE)
+    organization = models.ForeignKey(
+        Organization, related_name="mobile_app_notification_sends", on_delete=models.CASCADE,
+    )
+    payload = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    last_user_id = models.PositiveIntegerField(null=True, blank=True)
+    recipient_count = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def get_payload(self):
+        return json.loads(self.payload)
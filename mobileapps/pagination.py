@@ -0,0 +1,50 @@
+"""
+Pagination classes for the mobile apps API.
+"""
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Pages through results by an opaque cursor on the ordering columns instead of
+    an offset, so deep pages cost the same as the first one and no count is run.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('id', )
+
+
+class HistoryPagination(KeysetPagination):
+    """
+    Pages through mobile app history, newest first.
+    """
+    ordering = ('-created', '-id')
+
+
+class ThemePagination(KeysetPagination):
+    """
+    Pages through themes, newest first.
+
+    The cursor is positioned on the first ordering column, so it must never change;
+    ordering by `modified` would move themes edited during a walk across pages.
+    """
+    ordering = ('-created', '-id')
+
+
+class CursorPaginationMixin:
+    """
+    Lets a list view page by cursor on request, keeping page numbers as the default.
+
+    Requests carrying a `cursor` query parameter, empty for the first page, are
+    paginated with `cursor_pagination_class` and get `next` and `previous`
+    cursor links instead of `count` and `num_pages`.
+    """
+    cursor_pagination_class = KeysetPagination
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator') and \
+                self.cursor_pagination_class.cursor_query_param in self.request.query_params:
+            self._paginator = self.cursor_pagination_class()
+        return super().paginator
@@ -0,0 +1,100 @@
+"""
+Retention policy for the mobile app history.
+
+Every record is kept for `keep_all_days`, then only the last record per app and
+day until `daily_days`, then only the last record per app and week until
+`weekly_days`; older records are deleted. The most recent record of each app is
+always kept. Override any of the limits with the `MOBILEAPPS_HISTORY_RETENTION`
+setting.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from mobileapps.models import MobileAppHistory
+
+DEFAULT_HISTORY_RETENTION = {
+    'keep_all_days': 30,
+    'daily_days': 90,
+    'weekly_days': 365,
+}
+
+
+def get_history_retention():
+    """
+    Returns the history retention limits, in days.
+    """
+    retention = dict(DEFAULT_HISTORY_RETENTION)
+    retention.update(getattr(settings, 'MOBILEAPPS_HISTORY_RETENTION', {}))
+    return retention
+
+
+def _delete_history(ids):
+    return MobileAppHistory.objects.filter(pk__in=ids).delete()[0] if ids else 0
+
+
+def _drop_history(cutoff, now, batch_size):
+    """
+    Deletes records created before `cutoff`, walking the table in primary key batches.
+    """
+    latest_ids = set(MobileAppHistory.objects.as_of(now).values_list('id', flat=True))
+    expired = MobileAppHistory.objects.filter(created__lt=cutoff).order_by('pk')
+
+    deleted = 0
+    last_pk = 0
+    while True:
+        ids = list(expired.filter(pk__gt=last_pk).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        last_pk = ids[-1]
+        deleted += _delete_history([pk for pk in ids if pk not in latest_ids])
+
+
+def _compact_history(daily_cutoff, weekly_cutoff, keep_all_cutoff, batch_size):
+    """
+    Deletes all but the last record per app and day (before `keep_all_cutoff`) or
+    per app and week (before `daily_cutoff`), in batches of `batch_size` records.
+    """
+    records = MobileAppHistory.objects.filter(
+        mobile_app__isnull=False, created__gte=weekly_cutoff, created__lt=keep_all_cutoff,
+    ).order_by('mobile_app', 'created', 'id').values_list('id', 'mobile_app_id', 'created')
+
+    deleted = 0
+    ids = []
+    previous_id, previous_period = None, None
+    for pk, mobile_app_id, created in records.iterator():
+        if created >= daily_cutoff:
+            period = (mobile_app_id, created.date())
+        else:
+            period = (mobile_app_id, created.isocalendar()[:2])
+        if period == previous_period:
+            ids.append(previous_id)
+            if len(ids) >= batch_size:
+                deleted += _delete_history(ids)
+                ids = []
+        previous_id, previous_period = pk, period
+    return deleted + _delete_history(ids)
+
+
+def prune_mobile_app_history(now=None, batch_size=1000):
+    """
+    Applies the retention policy to the mobile app history.
+
+    Returns the number of records removed by compaction and by expiry, and the
+    time it took in seconds.
+    """
+    start = time.time()
+    now = now or timezone.now()
+    retention = get_history_retention()
+    keep_all_cutoff = now - timedelta(days=retention['keep_all_days'])
+    daily_cutoff = now - timedelta(days=retention['daily_days'])
+    weekly_cutoff = now - timedelta(days=retention['weekly_days'])
+
+    dropped = _drop_history(weekly_cutoff, now, batch_size)
+    compacted = _compact_history(daily_cutoff, weekly_cutoff, keep_all_cutoff, batch_size)
+    return {
+        'compacted': compacted,
+        'dropped': dropped,
+        'seconds': time.time() - start,
+    }
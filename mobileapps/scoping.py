@@ -0,0 +1,97 @@
+"""
+Restricts querysets to what a requester is allowed to see.
+
+Non-staff users only see the mobile apps, users, organizations and themes of
+their own organizations. Membership is checked with `IN (subquery)` semi-joins
+over the through tables rather than joins, which multiply rows and need a
+DISTINCT to undo. Unlike correlated EXISTS subqueries, which probe the through
+table once per candidate row, they can be driven from the organization index.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from edx_solutions_organizations.models import Organization
+from mobileapps.caching import (get_generations,
+                                get_user_organizations_generation_name)
+from mobileapps.models import MobileApp
+
+USER_ORGANIZATIONS_CACHE_KEY = 'mobileapps.user_organizations.{}.{}'
+
+# Seconds the organization ids of a user stay cached; changes invalidate them right away regardless.
+USER_ORGANIZATIONS_CACHE_TIMEOUT = getattr(settings, 'MOBILEAPPS_USER_ORGANIZATIONS_CACHE_TIMEOUT', 60 * 60)
+
+
+def get_user_organization_ids(user):
+    """
+    Returns the ids of the organizations of a user.
+
+    The ids are cached under the generation counter of the user's organizations,
+    which is bumped whenever they change, so querysets can filter on a literal list.
+    """
+    generation, = get_generations([get_user_organizations_generation_name(user.id)])
+    key = USER_ORGANIZATIONS_CACHE_KEY.format(user.id, generation)
+    organization_ids = cache.get(key)
+    if organization_ids is None:
+        organization_ids = list(
+            Organization.users.through.objects.filter(user_id=user.id).values_list('organization_id', flat=True)
+        )
+        cache.set(key, organization_ids, USER_ORGANIZATIONS_CACHE_TIMEOUT)
+    return organization_ids
+
+
+def filter_mobile_apps_by_organizations(queryset, organization_ids):
+    """
+    Restricts mobile apps to those in any of the given organizations.
+    """
+    memberships = MobileApp.organizations.through.objects.filter(organization_id__in=organization_ids)
+    return queryset.filter(pk__in=memberships.values('mobileapp_id'))
+
+
+def filter_mobile_apps_by_organization_name(queryset, organization_name):
+    """
+    Restricts mobile apps to those in an organization whose name contains `organization_name`.
+    """
+    memberships = MobileApp.organizations.through.objects.filter(organization__name__icontains=organization_name)
+    return queryset.filter(pk__in=memberships.values('mobileapp_id'))
+
+
+def scope_mobile_apps(queryset, user):
+    """
+    Restricts mobile apps to those visible to `user`.
+    """
+    if user.is_staff:
+        return queryset
+    organization_ids = get_user_organization_ids(user)
+    if not organization_ids:
+        return queryset.none()
+    return filter_mobile_apps_by_organizations(queryset, organization_ids)
+
+
+def scope_users(queryset, user):
+    """
+    Restricts users to those sharing an organization with `user`.
+    """
+    if user.is_staff:
+        return queryset
+    organization_ids = get_user_organization_ids(user)
+    if not organization_ids:
+        return queryset.none()
+    memberships = Organization.users.through.objects.filter(organization_id__in=organization_ids)
+    return queryset.filter(pk__in=memberships.values('user_id'))
+
+
+def scope_organizations(queryset, user):
+    """
+    Restricts organizations to those of `user`.
+    """
+    if user.is_staff:
+        return queryset
+    return queryset.filter(id__in=get_user_organization_ids(user))
+
+
+def scope_themes(queryset, user):
+    """
+    Restricts themes to those of the organizations of `user`.
+    """
+    if user.is_staff:
+        return queryset
+    return queryset.filter(organization_id__in=get_user_organization_ids(user))
@@ -1,6 +1,7 @@
 from django.conf import settings
 from mobileapps.image_helpers import get_image_urls_by_key
 from mobileapps.models import (DEPLOYMENT_CHOICES, MobileApp,
+                               MobileAppHistory, MobileAppUserImport,
                                NotificationProvider, Theme)
 from openedx.core.djangoapps.site_configuration import helpers as configuration_helpers
 from rest_framework import serializers
@@ -12,14 +13,62 @@ class NotificationProviderSerializer(serializers.ModelSerializer):
         model = NotificationProvider
 
 
+def get_expanded_fields(request):
+    """
+    Returns the names of the fields a request asked to expand via `?expand=users,organizations`.
+    """
+    if request is None:
+        return set()
+    return {name.strip() for name in request.query_params.get('expand', '').split(',') if name.strip()}
+
+
+def get_requested_fields(request):
+    """
+    Returns the names of the fields a GET request restricted its response to via
+    `?fields=name,current_version`, or None when all fields are to be returned.
+    """
+    if request is None or request.method != 'GET' or 'fields' not in request.query_params:
+        return None
+    return {name.strip() for name in request.query_params['fields'].split(',') if name.strip()}
+
+
 class MobileAppSerializer(serializers.ModelSerializer):
     deployment_mechanism = serializers.ChoiceField(choices=DEPLOYMENT_CHOICES, required=False)
+    user_count = serializers.SerializerMethodField()
+    organization_count = serializers.SerializerMethodField()
+
+    # Membership lists grow with the user base, so they are only returned when expanded.
+    EXPANDABLE_FIELDS = ('users', 'organizations')
 
     class Meta:
         model = MobileApp
         fields = '__all__'
         extra_kwargs = {'updated_by': {'read_only': True}}
 
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        expanded_fields = get_expanded_fields(request)
+        requested_fields = get_requested_fields(request)
+        if requested_fields is not None:
+            # Requesting a membership list by name expands it as well.
+            expanded_fields |= requested_fields
+            for name in list(fields):
+                if name != 'id' and name not in requested_fields:
+                    del fields[name]
+        for name in self.EXPANDABLE_FIELDS:
+            if name in fields and name not in expanded_fields:
+                fields[name].write_only = True
+        return fields
+
+    def get_user_count(self, mobile_app):
+        user_count = getattr(mobile_app, 'user_count', None)
+        return mobile_app.users.count() if user_count is None else user_count
+
+    def get_organization_count(self, mobile_app):
+        organization_count = getattr(mobile_app, 'organization_count', None)
+        return mobile_app.organizations.count() if organization_count is None else organization_count
+
     def _set_custom_validated_data(self, validated_data):
         """
         Here we are adding current user in 'updated_by' field
@@ -42,6 +91,23 @@ class BasicMobileAppSerializer(MobileAppSerializer):
                   'deployment_mechanism', 'current_version', 'is_active')
 
 
+class MobileAppHistorySerializer(serializers.ModelSerializer):
+    """ Serializer for MobileAppHistory without the provider credentials """
+
+    class Meta:
+        model = MobileAppHistory
+        exclude = ('provider_key', 'provider_secret')
+
+
+class MobileAppUserImportSerializer(serializers.ModelSerializer):
+    """ Serializer for the progress of a MobileAppUserImport """
+    throughput = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = MobileAppUserImport
+        exclude = ('file_name',)
+
+
 class ThemeSerializer(serializers.ModelSerializer):
     logo_image = serializers.SerializerMethodField()
     header_bg_image = serializers.SerializerMethodField()
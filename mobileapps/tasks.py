@@ -1,24 +1,246 @@
 """
-This file contains celery tasks for sending push notifications
+This file contains celery tasks for sending push notifications in batches, recording mobile
+app history and importing mobile app users
 """
 import logging
 
+from celery import group
 from celery.task import task  # pylint: disable=no-name-in-module, import-error
-from edx_notifications.lib.publisher import bulk_publish_notification_to_users
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import F
+from django.utils import timezone
+from edx_notifications.data import NotificationMessage
+from edx_notifications.lib.publisher import (bulk_publish_notification_to_users,
+                                             get_notification_type)
+from edx_solutions_organizations.models import Organization
+from mobileapps.membership import (add_members, chunked, get_membership_chunk_size,
+                                   iter_keyset_batches, read_user_identifiers,
+                                   resolve_user_identifiers)
+from mobileapps.models import (MobileAppHistory, MobileAppNotificationSend,
+                               MobileAppUserImport)
+from mobileapps.retention import prune_mobile_app_history
+from mobileapps.throttling import (DROPPED, RETRIED, acquire_notification_slot,
+                                   get_rate_limit_metrics, get_retry_countdown,
+                                   is_transient_error, record_rate_limit_event)
 
 log = logging.getLogger('edx.celery.task')
 
 
-@task()
-def publish_mobile_apps_notifications_task(user_ids, notification_msg, api_keys, provider):
+@task(bind=True, max_retries=None, acks_late=True, reject_on_worker_lost=True)
+def publish_mobile_apps_notifications_task(self, user_ids, notification_msg, api_keys, provider, failures=0):
     """
     This function will call the edx_notifications api method "bulk_publish_notification_to_users"
     and run as a new Celery task.
+
+    Batches are acknowledged once published, and redelivered when their worker is lost,
+    so a batch queued is eventually published or dropped even if its worker dies.
+
+    Calls are rate limited per provider and API key. Calls which failed with a transient
+    error are retried with exponential backoff and dropped after MOBILEAPPS_NOTIFICATION_MAX_RETRIES
+    failures, counted by `failures`. Throttled calls never reached the provider, so they are
+    retried once the allowance is renewed without using up that budget, and only dropped
+    after MOBILEAPPS_NOTIFICATION_MAX_THROTTLED_RETRIES retries. Other failures are dropped
+    at once, since part of the batch may have been notified already.
     """
+    wait = acquire_notification_slot(provider, api_keys)
+    if wait:
+        _retry_notifications(self, provider, failures, wait=wait)
+        return
+
     try:
         bulk_publish_notification_to_users(user_ids, notification_msg, preferred_channel=provider,
                                            channel_context={"api_credentials": api_keys})
     except Exception as ex:
         # Notifications are never critical, so we don't want to disrupt any
-        # other logic processing. So log and continue.
+        # other logic processing. So log and retry later if the provider may accept them then.
+        log.exception(ex)
+        if is_transient_error(ex):
+            _retry_notifications(self, provider, failures)
+        else:
+            _drop_notifications(provider, 'after an error which is not transient')
+
+
+def _retry_notifications(notifications_task, provider, failures, wait=None):
+    """
+    Retries a publish_mobile_apps_notifications_task which failed `failures` times
+    before, or drops it once it ran out of retries.
+
+    A task throttled `wait` seconds before its next allowance is retried after at least
+    that long, and counted against the retries allowed to throttled tasks instead.
+    """
+    throttled_retries = notifications_task.request.retries - failures
+    if wait is None:
+        retries, max_retries = failures, getattr(settings, 'MOBILEAPPS_NOTIFICATION_MAX_RETRIES', 8)
+        failures += 1
+    else:
+        retries = throttled_retries
+        max_retries = getattr(settings, 'MOBILEAPPS_NOTIFICATION_MAX_THROTTLED_RETRIES', 1000)
+    if retries >= max_retries:
+        _drop_notifications(provider, 'after {} failures and {} throttled retries'.format(failures, throttled_retries))
+        return
+
+    record_rate_limit_event(provider, RETRIED)
+    raise notifications_task.retry(kwargs={'failures': failures}, countdown=get_retry_countdown(retries, wait or 0))
+
+
+def _drop_notifications(provider, reason):
+    """
+    Counts and logs a batch of notifications given up on, along with the metrics of its provider.
+    """
+    record_rate_limit_event(provider, DROPPED)
+    log.error(
+        'Dropped notification to provider %s %s, %s', provider, reason,
+        ', '.join('{} {}'.format(count, event) for event, count in get_rate_limit_metrics(provider).items()),
+    )
+
+
+def get_notification_batch_size():
+    """
+    Returns the number of recipients published to by each notification task.
+    """
+    return getattr(settings, 'MOBILEAPPS_NOTIFICATION_BATCH_SIZE', 1000)
+
+
+def create_notification_message(app_id, payload):
+    """
+    Returns the notification message of a mobile app carrying `payload`.
+    """
+    notification_type = get_notification_type('open-edx.mobileapps.notifications')
+    notification_message = NotificationMessage(
+        namespace=str(app_id),
+        msg_type=notification_type,
+        payload=payload
+    )
+    return notification_message
+
+
+def dispatch_mobile_apps_notifications(user_id_batches, notification_msg, api_keys, provider, on_dispatch=None):
+    """
+    Publishes a notification to the users of `user_id_batches`, an iterable of lists
+    of user ids, through one `publish_mobile_apps_notifications_task` per batch, and
+    returns the number of batches.
+
+    Batches are queued right away, as groups of MOBILEAPPS_NOTIFICATION_WAVE_SIZE tasks,
+    on the MOBILEAPPS_NOTIFICATION_QUEUE queue, or the default one when it isn't set.
+    The number of batches in flight is bounded by the workers consuming that queue, at
+    their concurrency times their prefetch multiplier, e.g. 4 with
+    `celery worker -Q <queue> --concurrency 4 --prefetch-multiplier 1`; the rest wait
+    in the broker. `on_dispatch` is called with the batches of each group once it is queued.
+    """
+    wave_size = getattr(settings, 'MOBILEAPPS_NOTIFICATION_WAVE_SIZE', 8)
+    queue = getattr(settings, 'MOBILEAPPS_NOTIFICATION_QUEUE', None)
+    options = {'queue': queue} if queue else {}
+
+    batch_count = 0
+    for wave in chunked(user_id_batches, wave_size):
+        group(
+            publish_mobile_apps_notifications_task.s(batch, notification_msg, api_keys, provider)
+            for batch in wave
+        ).apply_async(**options)
+        batch_count += len(wave)
+        if on_dispatch is not None:
+            on_dispatch(wave)
+    return batch_count
+
+
+@task(bind=True, acks_late=True, max_retries=5, default_retry_delay=60)
+def publish_organization_notifications_task(self, notification_send_id):
+    """
+    Publishes the notification of a MobileAppNotificationSend to all the users of its organization.
+
+    The users are read by pages of the notification batch size, in increasing id order,
+    and the last user id dispatched is saved after each group of batches is queued. A
+    retried or redelivered task resumes after it, so only the part of the audience not
+    queued yet is dispatched again, along with at most the group in flight when it stopped.
+    The send thus tracks dispatch progress: `recipient_count` counts the recipients whose
+    batches were queued, and publishing them is up to the batch tasks, which are
+    acknowledged late so that the broker redelivers those lost with their worker.
+    The API credentials of the app are read here and passed to each batch task, like
+    the other notification endpoints do.
+    """
+    notification_send = MobileAppNotificationSend.objects.select_related('mobile_app').get(pk=notification_send_id)
+    if notification_send.status in (MobileAppNotificationSend.COMPLETED, MobileAppNotificationSend.FAILED):
+        return
+
+    sends = MobileAppNotificationSend.objects.filter(pk=notification_send_id)
+    sends.filter(started_at__isnull=True).update(started_at=timezone.now())
+    sends.update(status=MobileAppNotificationSend.RUNNING, modified=timezone.now())
+
+    def checkpoint(batches):
+        sends.update(
+            last_user_id=batches[-1][-1],
+            recipient_count=F('recipient_count') + sum(len(batch) for batch in batches),
+            modified=timezone.now(),
+        )
+
+    mobile_app = notification_send.mobile_app
+    memberships = Organization.users.through.objects.filter(organization_id=notification_send.organization_id)
+    try:
+        dispatch_mobile_apps_notifications(
+            iter_keyset_batches(
+                memberships, 'user_id', get_notification_batch_size(), after=notification_send.last_user_id,
+            ),
+            create_notification_message(mobile_app.id, notification_send.get_payload()),
+            mobile_app.get_api_keys(),
+            mobile_app.get_notification_provider_name(),
+            on_dispatch=checkpoint,
+        )
+    except Exception as ex:  # pylint: disable=broad-except
         log.exception(ex)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=ex)
+        sends.update(status=MobileAppNotificationSend.FAILED, finished_at=timezone.now(), modified=timezone.now())
+        return
+
+    sends.update(status=MobileAppNotificationSend.COMPLETED, finished_at=timezone.now(), modified=timezone.now())
+
+
+@task()
+def record_mobile_app_history_task(records):
+    """
+    Inserts the history records collected by `MobileAppHistoryBuffer` in one statement.
+    """
+    MobileAppHistory.objects.bulk_create([MobileAppHistory(**record) for record in records])
+
+
+@task()
+def prune_mobile_app_history_task():
+    """
+    Applies the history retention policy, meant to be scheduled periodically.
+    """
+    result = prune_mobile_app_history()
+    log.info(
+        'Pruned mobile app history: %s compacted, %s expired in %.1fs',
+        result['compacted'], result['dropped'], result['seconds'],
+    )
+
+
+@task()
+def import_mobile_app_users_task(user_import_id):
+    """
+    Adds the users listed in the file of a MobileAppUserImport to its mobile app,
+    resolving and inserting them in chunks and recording the progress after each chunk.
+    """
+    user_import = MobileAppUserImport.objects.select_related('mobile_app').get(pk=user_import_id)
+    imports = MobileAppUserImport.objects.filter(pk=user_import_id)
+    imports.update(status=MobileAppUserImport.RUNNING, started_at=timezone.now(), modified=timezone.now())
+
+    status = MobileAppUserImport.COMPLETED
+    try:
+        with default_storage.open(user_import.file_name, 'rb') as import_file:
+            identifiers = read_user_identifiers(import_file, user_import.file_format)
+            for chunk in chunked(identifiers, get_membership_chunk_size()):
+                user_ids, failed_count = resolve_user_identifiers(chunk)
+                add_members(user_import.mobile_app, 'users', user_ids)
+                imports.update(
+                    processed_count=F('processed_count') + len(chunk),
+                    failed_count=F('failed_count') + failed_count,
+                    modified=timezone.now(),
+                )
+    except Exception as ex:  # pylint: disable=broad-except
+        log.exception(ex)
+        status = MobileAppUserImport.FAILED
+
+    imports.update(status=status, finished_at=timezone.now(), modified=timezone.now())
+    default_storage.delete(user_import.file_name)
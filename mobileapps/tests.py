@@ -5,24 +5,70 @@ Run these tests @ Devstack:
 paver test_system -s lms -t mobileapps
 """
 import datetime
+import json
+import os
+import tempfile
+import time
 import uuid
+from io import StringIO
 
 import ddt
+from celery.exceptions import Retry
+from cryptography.fernet import Fernet
 from django.conf import settings
 from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.urls import reverse
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed
+from django.test import TransactionTestCase, override_settings
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
 from edx_notifications import startup
 from edx_solutions_api_integration.test_utils import (APIClientMixin,
                                                       get_temporary_image)
+from edx_solutions_api_integration.utils import StringCipher
 from edx_solutions_organizations.models import Organization
-from mobileapps.models import MobileApp, NotificationProvider, Theme
-from mock import patch
+from mobileapps.caching import (MOBILE_APPS_GENERATION, get_generations,
+                                get_mobile_app_generation_name)
+from mobileapps.management.commands.reencrypt_provider_credentials import \
+    Checkpoint
+from mobileapps.membership import add_members
+from mobileapps.models import (MobileApp, MobileAppHistory,
+                               MobileAppNotificationSend, MobileAppUserImport,
+                               NotificationProvider, Theme, decrypt_value)
+from mobileapps.retention import prune_mobile_app_history
+from mobileapps.scoping import get_user_organization_ids
+from mobileapps.tasks import (dispatch_mobile_apps_notifications,
+                              import_mobile_app_users_task,
+                              publish_mobile_apps_notifications_task,
+                              publish_organization_notifications_task)
+from mobileapps.throttling import (acquire_notification_slot,
+                                   get_rate_limit_metrics)
+from mobileapps.views import mobile_app_detail_cache
+from mock import Mock, call, patch
 from pytz import UTC
 from student.tests.factories import UserFactory
 from xmodule.modulestore.tests.django_utils import (
     TEST_DATA_SPLIT_MODULESTORE, ModuleStoreTestCase)
 
+
+class RotatedStringCipher:
+    """
+    Stands in for StringCipher once its key has been rotated.
+    """
+    fernet = Fernet(Fernet.generate_key())
+
+    @classmethod
+    def encrypt(cls, value):
+        return cls.fernet.encrypt(value.encode('utf-8')).decode('utf-8')
+
+    @classmethod
+    def decrypt(cls, value):
+        return cls.fernet.decrypt(value)
+
+
 TEST_LOGO_IMAGE_UPLOAD_DT = datetime.datetime(2002, 1, 9, 15, 43, tzinfo=UTC)
 TEST_HEADER_BG_IMAGE_UPLOAD_DT = datetime.datetime(2002, 1, 9, 20, 43, tzinfo=UTC)
 
@@ -116,6 +162,7 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.client.login(username=self.user.username, password='test_password')
 
         cache.clear()
+        mobile_app_detail_cache.clear()
 
     def login_with_non_staff_user(self):
         self.client.logout()
@@ -172,13 +219,21 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         for i, mobileapp in enumerate(response.data['results']):
             self.assertEqual(mobileapp['name'], 'Test Mobile App {}'.format(i))
             self.assertEqual(mobileapp['updated_by'], self.user.id)
-            self.assertEqual(len(mobileapp['users']), len(users))
-            self.assertEqual(len(mobileapp['organizations']), len(organizations))
+            self.assertEqual(mobileapp['user_count'], len(users))
+            self.assertEqual(mobileapp['organization_count'], len(organizations))
+            self.assertNotIn('users', mobileapp)
+            self.assertNotIn('organizations', mobileapp)
             self.assertIsNotNone(mobileapp['created'])
             self.assertIsNotNone(mobileapp['modified'])
             self.assertIsNotNone(mobileapp['ios_app_id'])
             self.assertIsNotNone(mobileapp['ios_bundle_id'])
 
+        response = self.do_get('{}?expand=users,organizations'.format(self.base_mobileapps_uri))
+        self.assertEqual(response.status_code, 200)
+        for mobileapp in response.data['results']:
+            self.assertEqual(mobileapp['users'], [user.id for user in users])
+            self.assertEqual(len(mobileapp['organizations']), len(organizations))
+
         # fetch data with page outside range
         response = self.do_get('{}?page=5'.format(self.base_mobileapps_uri))
         self.assertEqual(response.status_code, 404)
@@ -188,6 +243,27 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), len(mobile_apps))
 
+    def test_mobileapps_list_query_count(self):
+        organization = Organization.objects.create(name='ABC Organization')
+        users = UserFactory.create_batch(3)
+        for i in range(20):
+            self.setup_test_mobileapp(mobileapp_data={
+                'name': 'Test Mobile App {}'.format(i),
+                'users': [user.id for user in users],
+                'organizations': [organization.id],
+            })
+
+        query_counts = []
+        for page_size in (2, 20):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.do_get('{}?expand=users,organizations&page_size={}'.format(
+                    self.base_mobileapps_uri, page_size,
+                ))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), page_size)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_mobileapps_list_by_non_staff(self):
         """
         Tests mobile apps list view with non staff user
@@ -213,6 +289,72 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['count'], 1)
 
+    def test_mobileapps_list_by_non_staff_shared_organizations(self):
+        """
+        Tests mobile apps list view with non staff user in several organizations of the same app
+        """
+        organizations = [Organization.objects.create(name='Organization {}'.format(i)) for i in range(3)]
+        mobile_app = self.setup_test_mobileapp(mobileapp_data={
+            'name': 'Shared Mobile App',
+            'organizations': [org.id for org in organizations],
+        })
+        for org in organizations:
+            org.users.add(self.non_staff_user)
+
+        self.login_with_non_staff_user()
+        response = self.do_get('{}?organization_ids={}'.format(
+            self.base_mobileapps_uri, ','.join(str(org.id) for org in organizations),
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], mobile_app['id'])
+
+    def test_mobileapps_list_cursor_pagination(self):
+        """
+        Tests mobile apps list view paged by cursor
+        """
+        mobile_app_ids = [
+            self.setup_test_mobileapp(mobileapp_data={'name': 'Test Mobile App {}'.format(i)})['id']
+            for i in range(5)
+        ]
+
+        response = self.do_get('{}?page_size=2'.format(self.base_mobileapps_uri))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['num_pages'], 3)
+
+        seen_ids = []
+        uri = '{}?cursor=&page_size=2'.format(self.base_mobileapps_uri)
+        while uri:
+            response = self.do_get(uri)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            seen_ids.extend(mobile_app['id'] for mobile_app in response.data['results'])
+            uri = response.data['next']
+        self.assertEqual(seen_ids, sorted(mobile_app_ids))
+
+    def test_mobileapps_sparse_fields(self):
+        """
+        Tests mobile apps list and detail views restricted to a few fields
+        """
+        users = UserFactory.create_batch(2)
+        mobile_app = self.setup_test_mobileapp(mobileapp_data={'users': [user.id for user in users]})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.do_get('{}?fields=name,current_version'.format(self.base_mobileapps_uri))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'current_version'})
+        for query in queries:
+            self.assertNotIn('provider_secret', query['sql'])
+            self.assertNotIn('mobileapps_mobileapp_users', query['sql'])
+
+        response = self.do_get('{}?fields=name,users,user_count'.format(
+            reverse('mobileapps-detail', kwargs={'pk': mobile_app['id']}),
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'id', 'name', 'users', 'user_count'})
+        self.assertEqual(sorted(response.data['users']), sorted(user.id for user in users))
+        self.assertEqual(response.data['user_count'], 2)
+
     def test_mobileapps_list_search_by_app_name(self):
         mobile_apps = []
 
@@ -287,7 +429,7 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
                 "name": 'XYZ App', "organizations": [organization2.id]})
         )
 
-        response = self.do_get('{}?organization_ids={},{}'.format(
+        response = self.do_get('{}?expand=organizations&organization_ids={},{}'.format(
             self.base_mobileapps_uri,
             organization1.id,
             organization2.id,
@@ -298,7 +440,9 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.data['results'][0]['organizations'], [organization1.id, organization2.id])
         self.assertEqual(response.data['results'][1]['organizations'], [organization2.id])
 
-        response = self.do_get('{}?organization_ids={}'.format(self.base_mobileapps_uri, organization1.id))
+        response = self.do_get('{}?expand=organizations&organization_ids={}'.format(
+            self.base_mobileapps_uri, organization1.id,
+        ))
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['count'], 1)
@@ -350,6 +494,90 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertIsNotNone(response.data['created'])
         self.assertIsNotNone(response.data['modified'])
 
+    def test_mobileapps_detail_conditional_get(self):
+        mobileapp_data = self.setup_test_mobileapp()
+        uri = reverse('mobileapps-detail', kwargs={'pk': mobileapp_data['id']})
+
+        response = self.client.get(uri)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(len([query for query in queries if 'mobileapps_mobileapp' in query['sql']]), 1)
+
+        response = self.client.get(uri, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Membership changes leave `modified` as it is, but must still invalidate Last-Modified.
+        with patch('mobileapps.caching.time.time', return_value=time.time() + 60):
+            response = self.do_post(reverse('mobileapps-users', kwargs={'mobile_app_id': mobileapp_data['id']}), {
+                'users': [UserFactory.create().id],
+            })
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(uri, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get('{}?fields=name'.format(uri), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.do_patch(uri, data={'name': 'XYZ App'})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['name'], 'XYZ App')
+
+    def test_mobileapps_list_conditional_get(self):
+        self.setup_test_mobileapp()
+
+        response = self.client.get(self.base_mobileapps_uri)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        response = self.client.get(self.base_mobileapps_uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.setup_test_mobileapp(mobileapp_data={'name': 'XYZ App'})
+        response = self.client.get(self.base_mobileapps_uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+
+    def test_mobileapps_detail_cached(self):
+        mobileapp_data = self.setup_test_mobileapp(mobileapp_data={'provider_secret': 'ABC secret'})
+        uri = reverse('mobileapps-detail', kwargs={'pk': mobileapp_data['id']})
+
+        response = self.do_get(uri)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mobile_app_detail_cache.info().misses, 1)
+
+        response = self.do_get(uri)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['provider_secret'], 'ABC secret')
+        self.assertEqual(mobile_app_detail_cache.info().local_hits, 1)
+
+        mobile_app_detail_cache.clear()
+        response = self.do_get(uri)
+        self.assertEqual(response.data['provider_secret'], 'ABC secret')
+        self.assertEqual(mobile_app_detail_cache.info().hits, 1)
+
+        response = self.do_get('{}?expand=users'.format(uri))
+        self.assertEqual(response.data['users'], [])
+        self.assertEqual(mobile_app_detail_cache.info().misses, 1)
+
+        user = UserFactory.create()
+        response = self.do_post(reverse('mobileapps-users', kwargs={'mobile_app_id': mobileapp_data['id']}), {
+            'users': [user.id],
+        })
+        self.assertEqual(response.status_code, 201)
+        response = self.do_get('{}?expand=users'.format(uri))
+        self.assertEqual(response.data['users'], [user.id])
+        self.assertEqual(response.data['user_count'], 1)
+
     def test_mobileapps_detail_put(self):
         mobileapp = MobileApp.objects.create(
             name='ABC App',
@@ -472,6 +700,74 @@ class MobileappsApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.data['count'], 1)
         self.assertEqual(response.data['results'][0]['is_active'], False)
 
+    def test_mobileapps_history(self):
+        mobileapp = MobileApp.objects.create(
+            name='ABC App',
+            current_version=self.test_mobileapp_current_version,
+            deployment_mechanism=self.test_mobileapp_deployment_mechanism,
+            updated_by=self.user,
+        )
+        for version in range(25):
+            MobileAppHistory.objects.create(
+                mobile_app=mobileapp,
+                name=mobileapp.name,
+                current_version=str(version),
+                deployment_mechanism=mobileapp.deployment_mechanism,
+                updated_by=self.user,
+            )
+        history_uri = reverse('mobileapps-history', kwargs={'mobile_app_id': mobileapp.id})
+
+        response = self.do_get(history_uri)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(response.data['results'][0]['current_version'], '24')
+        self.assertNotIn('provider_key', response.data['results'][0])
+        self.assertIsNone(response.data['previous'])
+
+        response = self.do_get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertEqual(response.data['results'][-1]['current_version'], '0')
+        self.assertIsNone(response.data['next'])
+
+        self.login_with_non_staff_user()
+        response = self.do_get(history_uri)
+        self.assertEqual(response.status_code, 403)
+
+    def test_mobileapps_detail_as_of(self):
+        mobileapp = MobileApp.objects.create(
+            name='ABC App',
+            current_version='3',
+            deployment_mechanism=self.test_mobileapp_deployment_mechanism,
+            updated_by=self.user,
+        )
+        for day, version in ((1, '1'), (5, '2'), (9, '3')):
+            MobileAppHistory.objects.create(
+                mobile_app=mobileapp,
+                name=mobileapp.name,
+                current_version=version,
+                deployment_mechanism=mobileapp.deployment_mechanism,
+                updated_by=self.user,
+                created=datetime.datetime(2017, 12, day, tzinfo=UTC),
+            )
+        detail_uri = reverse('mobileapps-detail', kwargs={'pk': mobileapp.id})
+
+        response = self.do_get('{}?as_of=2017-12-06T00:00:00Z'.format(detail_uri))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['current_version'], '2')
+        self.assertEqual(response.data['mobile_app'], mobileapp.id)
+
+        response = self.do_get('{}?as_of=2017-11-30T00:00:00'.format(detail_uri))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.do_get('{}?as_of=yesterday'.format(detail_uri))
+        self.assertEqual(response.status_code, 400)
+        response = self.do_get('{}?as_of=2017-13-45T00:00:00'.format(detail_uri))
+        self.assertEqual(response.status_code, 400)
+
+        snapshots = MobileAppHistory.objects.as_of(datetime.datetime(2017, 12, 10, tzinfo=UTC))
+        self.assertEqual([snapshot.current_version for snapshot in snapshots], ['3'])
+
 
 @ddt.ddt
 class MobileappsUserApiTests(ModuleStoreTestCase, APIClientMixin):
@@ -592,6 +888,101 @@ class MobileappsUserApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(len(response.data['results']), 2)
         self.assertEqual(response.data['num_pages'], 1)
 
+    def test_mobileapps_users_add_existing_and_unknown(self):
+        data = {
+            "users": [user.id for user in self.users] + [user.id for user in UserFactory.create_batch(2)] + [0]
+        }
+
+        with override_settings(MOBILEAPPS_MEMBERSHIP_CHUNK_SIZE=2):
+            response = self.do_post(
+                reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.mobileapp.users.count(), len(self.users) + 2)
+
+        with override_settings(MOBILEAPPS_MEMBERSHIP_CHUNK_SIZE=2):
+            response = self.do_delete(
+                reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data
+            )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.mobileapp.users.count(), 0)
+
+    @ddt.data(
+        ('users.csv', 'user\n{id}\n{username}\n{email}\nunknown\n'),
+        ('users.ndjson', '{id}\n"{username}"\n{{"email": "{email}"}}\n"unknown"\n'),
+    )
+    @ddt.unpack
+    def test_mobileapps_users_import(self, file_name, content):
+        new_users = UserFactory.create_batch(3)
+        content = content.format(id=new_users[0].id, username=new_users[1].username, email=new_users[2].email)
+        imports_uri = reverse('mobileapps-users-imports', kwargs={'mobile_app_id': self.mobileapp.id})
+
+        response = self.client.post(imports_uri, {'file': SimpleUploadedFile(file_name, content.encode('utf-8'))})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], MobileAppUserImport.PENDING)
+
+        with override_settings(MOBILEAPPS_MEMBERSHIP_CHUNK_SIZE=2):
+            import_mobile_app_users_task(response.data['id'])
+
+        response = self.do_get(reverse('mobileapps-users-imports-detail', kwargs={
+            'mobile_app_id': self.mobileapp.id, 'import_id': response.data['id'],
+        }))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], MobileAppUserImport.COMPLETED)
+        self.assertEqual(response.data['processed_count'], 4)
+        self.assertEqual(response.data['failed_count'], 1)
+        self.assertEqual(self.mobileapp.users.count(), len(self.users) + 3)
+
+        response = self.client.post(imports_uri, {'file': SimpleUploadedFile('users.txt', b'1')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_mobileapps_users_import_csv_header_only_in_first_row(self):
+        new_users = [UserFactory.create(username='email'), UserFactory.create(username='987654321')]
+        content = '\ufeffusername\nemail\n987654321\n'
+        imports_uri = reverse('mobileapps-users-imports', kwargs={'mobile_app_id': self.mobileapp.id})
+
+        response = self.client.post(imports_uri, {'file': SimpleUploadedFile('users.csv', content.encode('utf-8'))})
+        self.assertEqual(response.status_code, 202)
+        import_mobile_app_users_task(response.data['id'])
+
+        user_import = MobileAppUserImport.objects.get(id=response.data['id'])
+        self.assertEqual(user_import.status, MobileAppUserImport.COMPLETED)
+        self.assertEqual((user_import.processed_count, user_import.failed_count), (2, 0))
+        self.assertEqual(
+            set(self.mobileapp.users.values_list('id', flat=True)), {user.id for user in self.users + new_users}
+        )
+
+    def test_mobileapps_users_sync(self):
+        new_users = UserFactory.create_batch(2)
+        data = {
+            "users": [user.id for user in self.users[:3] + new_users]
+        }
+
+        response = self.do_put(reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'added': 2, 'removed': 2})
+        self.assertEqual(set(self.mobileapp.users.values_list('id', flat=True)), set(data['users']))
+
+        self.login_with_non_staff_user()
+        response = self.do_put(reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data)
+        self.assertEqual(response.status_code, 403)
+
+    def test_mobileapps_users_sync_more_ids_than_chunk_size(self):
+        new_users = UserFactory.create_batch(5)
+        data = {
+            "users": [user.id for user in self.users[2:] + new_users] + [0]
+        }
+
+        with override_settings(MOBILEAPPS_MEMBERSHIP_CHUNK_SIZE=2):
+            response = self.do_put(
+                reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'added': 5, 'removed': 2})
+        self.assertEqual(
+            set(self.mobileapp.users.values_list('id', flat=True)), {user.id for user in self.users[2:] + new_users}
+        )
+
     def test_mobileapp_users_post_delete_with_non_staff_user(self):
         """
         Tests post/delete requests on mobilieapps users view should fail due to staff only permissions
@@ -610,6 +1001,20 @@ class MobileappsUserApiTests(ModuleStoreTestCase, APIClientMixin):
         response = self.do_delete(reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}), data=data)
         self.assertEqual(response.status_code, 403)
 
+    def test_mobileapp_users_get_cursor_pagination(self):
+        """
+        Tests mobile app users get paged by cursor
+        """
+        uri = reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id})
+        response = self.do_get('{}?cursor=&page_size=3'.format(uri))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user['id'] for user in response.data['results']], [user.id for user in self.users[:3]])
+
+        response = self.do_get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user['id'] for user in response.data['results']], [user.id for user in self.users[3:]])
+        self.assertIsNone(response.data['next'])
+
     def test_mobileapp_users_get_non_staff(self):
         """
         Tests mobile app users get for non staff user
@@ -638,6 +1043,21 @@ class MobileappsUserApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['count'], 0)
 
+    def test_mobileapp_users_get_non_staff_shared_organizations(self):
+        """
+        Tests mobile app users get for non staff user sharing several organizations with the users
+        """
+        organizations = [Organization.objects.create(name='Organization {}'.format(i)) for i in range(3)]
+        for organization in organizations:
+            organization.users.add(self.non_staff_user, *self.users)
+            self.mobileapp.organizations.add(organization)
+
+        self.login_with_non_staff_user()
+        response = self.do_get(reverse('mobileapps-users', kwargs={'mobile_app_id': self.mobileapp.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], len(self.users))
+        self.assertEqual(len({user['id'] for user in response.data['results']}), len(self.users))
+
 
 @ddt.ddt
 class MobileappsOrganizationApiTests(ModuleStoreTestCase, APIClientMixin):
@@ -775,6 +1195,30 @@ class MobileappsOrganizationApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(response.data['num_pages'], 1)
         self.assertEqual(response.data['results'][0]['name'], self.organizations[1].name)
 
+    def test_mobileapps_organizations_sync(self):
+        new_organization = Organization.objects.create(name='New Organization')
+        data = {
+            "organizations": [self.organizations[1].id, new_organization.id, 0]
+        }
+
+        response = self.do_put(reverse('mobileapps-organizations', kwargs={'mobile_app_id': self.mobileapp.id}),
+                               data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'added': 1, 'removed': 1})
+        self.assertEqual(
+            set(self.mobileapp.organizations.values_list('id', flat=True)),
+            {self.organizations[1].id, new_organization.id},
+        )
+
+        response = self.do_put(reverse('mobileapps-organizations', kwargs={'mobile_app_id': self.mobileapp.id}),
+                               data={"organizations": []})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'added': 0, 'removed': 2})
+
+        response = self.do_put(reverse('mobileapps-organizations', kwargs={'mobile_app_id': self.mobileapp.id}),
+                               data={"organizations": ['abc']})
+        self.assertEqual(response.status_code, 400)
+
     def test_mobileapp_organizations_post_delete_with_non_staff_user(self):
         """
         Tests post/delete requests on mobilieapps organizations view should fail due to staff only permissions
@@ -1057,6 +1501,261 @@ class MobileappsNotificationsTests(ModuleStoreTestCase, APIClientMixin):
                                                 'organization_id': self.organization1_id}), data=data)
         self.assertEqual(response.status_code, 400)
 
+    @override_settings(MOBILEAPPS_NOTIFICATION_BATCH_SIZE=2, MOBILEAPPS_NOTIFICATION_WAVE_SIZE=2)
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_mobileapp_organization_users_notifications_batches(self, mock_bulk_publish):
+        """
+        send a notification to all the users of an organization in batches of users
+        """
+        data = {'message': 'Test message to all the users of an organization'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.do_post(reverse('mobileapps-organization-all-users-notifications',
+                                            kwargs={'mobile_app_id': self.mobile_app1_id,
+                                                    'organization_id': self.organization1_id}), data=data)
+        self.assertEqual(response.status_code, 202)
+        organization_users_table = Organization.users.through._meta.db_table
+        self.assertFalse([query for query in queries if organization_users_table in query['sql']])
+
+        notification_send = MobileAppNotificationSend.objects.get(mobile_app_id=self.mobile_app1_id)
+        self.assertEqual(notification_send.status, MobileAppNotificationSend.PENDING)
+        self.assertEqual(notification_send.get_payload(), {'title': data['message']})
+
+        publish_organization_notifications_task(notification_send.id)
+
+        batches = [call[0][0] for call in mock_bulk_publish.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        organization_user_ids = sorted(
+            Organization.objects.get(id=self.organization1_id).users.values_list('id', flat=True)
+        )
+        self.assertEqual(sorted(sum(batches, [])), organization_user_ids)
+
+        notification_send.refresh_from_db()
+        self.assertEqual(notification_send.status, MobileAppNotificationSend.COMPLETED)
+        self.assertEqual(notification_send.recipient_count, 5)
+        self.assertEqual(notification_send.last_user_id, organization_user_ids[-1])
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_QUEUE='mobileapps.notifications', MOBILEAPPS_NOTIFICATION_WAVE_SIZE=2)
+    @patch('mobileapps.tasks.group')
+    def test_dispatch_notifications_to_queue(self, mock_group):
+        """
+        notification batches are queued at once on the notification queue, without an ETA
+        """
+        batch_count = dispatch_mobile_apps_notifications([[1], [2], [3]], 'Test message', {}, 'test-provider')
+        self.assertEqual(batch_count, 3)
+        self.assertEqual(
+            mock_group.return_value.apply_async.call_args_list, [call(queue='mobileapps.notifications')] * 2,
+        )
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_BATCH_SIZE=2, MOBILEAPPS_NOTIFICATION_WAVE_SIZE=1)
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_mobileapp_organization_users_notifications_resume(self, mock_bulk_publish):
+        """
+        resume an interrupted notification send to all the users of an organization after its checkpoint
+        """
+        organization_user_ids = sorted(
+            Organization.objects.get(id=self.organization1_id).users.values_list('id', flat=True)
+        )
+        notification_send = MobileAppNotificationSend.objects.create(
+            mobile_app_id=self.mobile_app1_id,
+            organization_id=self.organization1_id,
+            payload=json.dumps({'title': 'Test message'}),
+            status=MobileAppNotificationSend.RUNNING,
+            last_user_id=organization_user_ids[1],
+            recipient_count=2,
+        )
+
+        publish_organization_notifications_task(notification_send.id)
+
+        batches = [call[0][0] for call in mock_bulk_publish.call_args_list]
+        self.assertEqual(batches, [organization_user_ids[2:4], organization_user_ids[4:]])
+        notification_send.refresh_from_db()
+        self.assertEqual(notification_send.status, MobileAppNotificationSend.COMPLETED)
+        self.assertEqual(notification_send.recipient_count, 5)
+
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_mobileapp_selected_users_notifications_recipients(self, mock_bulk_publish):
+        """
+        send a notification to selected users once each, skipping those who aren't users of the app
+        """
+        member_ids = sorted(MobileApp.objects.get(id=self.mobile_app1_id).users.values_list('id', flat=True))
+        data = {
+            'message': 'Test message to selected users of an app',
+            'users': [member_ids[1], member_ids[0], member_ids[1], self.user.id],
+        }
+        response = self.do_post(
+            reverse('mobileapps-selected-users-notifications', kwargs={'mobile_app_id': self.mobile_app1_id}), data=data)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([call[0][0] for call in mock_bulk_publish.call_args_list], [member_ids[:2]])
+
+        data['users'] = ['abc']
+        response = self.do_post(
+            reverse('mobileapps-selected-users-notifications', kwargs={'mobile_app_id': self.mobile_app1_id}), data=data)
+        self.assertEqual(response.status_code, 400)
+
+    @patch('mobileapps.views.publish_mobile_apps_notifications_task.delay')
+    def test_mobileapp_all_users_notifications_idempotency_key(self, mock_delay):
+        """
+        send a notification to all the users of a given mobile app once per idempotency key
+        """
+        uri = reverse('mobileapps-all-users-notifications', kwargs={'mobile_app_id': self.mobile_app1_id})
+        data = json.dumps({'message': 'Test message to all the users of an app'})
+        idempotency_key = str(uuid.uuid4())
+
+        for __ in range(2):
+            response = self.client.post(
+                uri, data=data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=idempotency_key,
+            )
+            self.assertEqual(response.status_code, 202)
+        self.assertEqual(mock_delay.call_count, 1)
+
+        response = self.client.post(
+            uri, data=data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=str(uuid.uuid4()),
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(mock_delay.call_count, 2)
+
+        response = self.client.post(
+            uri, data=json.dumps({'message': 'Another message'}), content_type='application/json',
+            HTTP_IDEMPOTENCY_KEY=idempotency_key,
+        )
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(mock_delay.call_count, 2)
+
+    @override_settings(MOBILEAPPS_IDEMPOTENCY_IN_PROGRESS_TIMEOUT=30)
+    @patch('mobileapps.views.publish_mobile_apps_notifications_task.delay')
+    def test_mobileapp_all_users_notifications_idempotency_key_of_killed_request(self, mock_delay):
+        """
+        an idempotency key whose request was killed while running can be retried once its claim expires
+        """
+        uri = reverse('mobileapps-all-users-notifications', kwargs={'mobile_app_id': self.mobile_app1_id})
+        data = json.dumps({'message': 'Test message to all the users of an app'})
+        idempotency_key = str(uuid.uuid4())
+
+        mock_delay.side_effect = SystemExit
+        with patch('mobileapps.caching.cache.add', wraps=cache.add) as mock_add:
+            with self.assertRaises(SystemExit):
+                self.client.post(
+                    uri, data=data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=idempotency_key,
+                )
+        cache_key, claim, timeout = next(
+            add_call[0] for add_call in mock_add.call_args_list if isinstance(add_call[0][1], dict)
+        )
+        self.assertEqual(claim['status'], 'in-progress')
+        self.assertEqual(timeout, 30)
+
+        mock_delay.side_effect = None
+        response = self.client.post(
+            uri, data=data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=idempotency_key,
+        )
+        self.assertEqual(response.status_code, 409)
+
+        # The claim expires after its timeout.
+        cache.delete(cache_key)
+        response = self.client.post(
+            uri, data=data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=idempotency_key,
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(mock_delay.call_count, 2)
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_RATE_LIMITS={'test-provider': (2, 4)})
+    def test_notification_provider_rate_limit(self):
+        """
+        calls to a notification provider are limited per API key
+        """
+        api_keys = {'provider_key': 'test key', 'provider_secret': 'test secret'}
+        self.assertEqual(acquire_notification_slot('test-provider', api_keys, now=1000.5), 0)
+        self.assertEqual(acquire_notification_slot('test-provider', api_keys, now=1000.5), 0)
+        self.assertEqual(acquire_notification_slot('test-provider', api_keys, now=1000.5), 0.5)
+        self.assertEqual(acquire_notification_slot('test-provider', {'provider_key': 'other key'}, now=1000.5), 0)
+        self.assertEqual(acquire_notification_slot('test-provider', api_keys, now=1002.5), 0)
+        self.assertEqual(
+            get_rate_limit_metrics('test-provider'),
+            {'allowed': 4, 'throttled': 1, 'retried': 0, 'dropped': 0},
+        )
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_RATE_LIMITS={'test-provider': (2, 4)})
+    def test_notification_provider_rate_limit_across_windows(self):
+        """
+        calls to a notification provider on both sides of a window boundary don't exceed its burst
+        """
+        api_keys = {'provider_key': 'test key', 'provider_secret': 'test secret'}
+        allowed = [
+            acquire_notification_slot('test-provider', api_keys, now=now) == 0
+            for now in (1000.9, 1000.9, 1000.9, 1001.0, 1001.0, 1001.0)
+        ]
+        self.assertEqual(allowed.count(True), 4)
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_RATE_LIMITS={'test-provider': (1, 1)})
+    @patch('mobileapps.throttling.time.time', return_value=1000.5)
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_publish_notifications_throttled(self, mock_bulk_publish, mock_time):
+        """
+        throttled calls to a notification provider are retried instead of dropped
+        """
+        api_keys = {'provider_key': 'test key', 'provider_secret': 'test secret'}
+        publish_mobile_apps_notifications_task([1], 'Test message', api_keys, 'test-provider')
+        with self.assertRaises(Retry):
+            publish_mobile_apps_notifications_task([2], 'Test message', api_keys, 'test-provider')
+
+        self.assertEqual(mock_bulk_publish.call_count, 1)
+        metrics = get_rate_limit_metrics('test-provider')
+        self.assertEqual((metrics['throttled'], metrics['retried']), (1, 1))
+
+    @override_settings(
+        MOBILEAPPS_NOTIFICATION_RATE_LIMITS={'test-provider': (1, 1)},
+        MOBILEAPPS_NOTIFICATION_MAX_RETRIES=2,
+        MOBILEAPPS_NOTIFICATION_MAX_THROTTLED_RETRIES=30,
+    )
+    @patch('mobileapps.throttling.time.time', return_value=1000.5)
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_publish_notifications_throttled_retries_budget(self, mock_bulk_publish, mock_time):
+        """
+        throttled retries don't use up the retries of failed calls, and have a budget of their own
+        """
+        api_keys = {'provider_key': 'test key', 'provider_secret': 'test secret'}
+        publish_mobile_apps_notifications_task([1], 'Test message', api_keys, 'test-provider')
+
+        publish_mobile_apps_notifications_task.push_request(retries=20)
+        try:
+            with self.assertRaises(Retry):
+                publish_mobile_apps_notifications_task([2], 'Test message', api_keys, 'test-provider', failures=1)
+        finally:
+            publish_mobile_apps_notifications_task.pop_request()
+
+        publish_mobile_apps_notifications_task.push_request(retries=32)
+        try:
+            publish_mobile_apps_notifications_task([2], 'Test message', api_keys, 'test-provider', failures=1)
+        finally:
+            publish_mobile_apps_notifications_task.pop_request()
+
+        self.assertEqual(mock_bulk_publish.call_count, 1)
+        metrics = get_rate_limit_metrics('test-provider')
+        self.assertEqual((metrics['throttled'], metrics['retried'], metrics['dropped']), (2, 1, 1))
+
+        out = StringIO()
+        call_command('notification_rate_limit_metrics', 'test-provider', stdout=out)
+        self.assertEqual(out.getvalue(), 'test-provider: 1 allowed, 2 throttled, 1 retried, 1 dropped\n')
+
+    @override_settings(MOBILEAPPS_NOTIFICATION_RATE_LIMITS={'test-provider': (None, None)})
+    @patch('mobileapps.tasks.bulk_publish_notification_to_users')
+    def test_publish_notifications_failed(self, mock_bulk_publish):
+        """
+        only transient provider errors are retried, other failures are dropped
+        """
+        api_keys = {'provider_key': 'test key', 'provider_secret': 'test secret'}
+        unavailable = IOError('Service Unavailable')
+        unavailable.response = Mock(status_code=503)
+        mock_bulk_publish.side_effect = unavailable
+        with self.assertRaises(Retry):
+            publish_mobile_apps_notifications_task([1], 'Test message', api_keys, 'test-provider')
+
+        mock_bulk_publish.side_effect = ValueError('Invalid payload')
+        publish_mobile_apps_notifications_task([1], 'Test message', api_keys, 'test-provider')
+
+        self.assertEqual(mock_bulk_publish.call_count, 2)
+        metrics = get_rate_limit_metrics('test-provider')
+        self.assertEqual((metrics['retried'], metrics['dropped']), (1, 1))
+
     def test_mobileapp_notifications_post_with_non_staff_user(self):
         """
         Tests post requests on all mobilieapps notification views by non staff users
@@ -1342,6 +2041,27 @@ class MobileappsThemeApiTests(ModuleStoreTestCase, APIClientMixin):
         self.assertEqual(theme.active, None)
         self.assertEqual(theme.name, 'Blue')
 
+    def test_mobileapps_organization_theme_conditional_get_after_activating_another(self):
+        organization_theme = Theme.objects.create(name='Blue', active=True, organization=self.organization1)
+        detail_uri = reverse('mobileapps-organization-themes-detail', kwargs={'theme_id': organization_theme.id})
+        list_uri = reverse('mobileapps-organization-themes', kwargs={'organization_id': self.organization1.id})
+
+        response = self.client.get(detail_uri)
+        self.assertEqual(response.status_code, 200)
+        detail_etag = response['ETag']
+        response = self.client.get(list_uri)
+        self.assertEqual(response.status_code, 200)
+        list_etag = response['ETag']
+
+        response = self.do_post_multipart(list_uri, {'name': 'Green Theme', 'active': True})
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.get(detail_uri, HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['active'])
+        response = self.client.get(list_uri, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 200)
+
     def test_mobileapps_organization_theme_detail(self):
         organization_theme = Theme.objects.create(
             name='Blue',
@@ -1688,3 +2408,253 @@ class MobileappsThemeApiTests(ModuleStoreTestCase, APIClientMixin):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['logo_image']['has_image'], False)
+
+
+class MobileAppModelTests(TransactionTestCase):
+    """ Test suite for MobileApp model behaviour """
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserFactory.create()
+        self.mobileapp = MobileApp.objects.create(
+            name='Test App',
+            current_version='1',
+            provider_key='test key',
+            provider_secret='test secret',
+            updated_by=self.user,
+        )
+        decrypt_value.cache_clear()
+        cache.clear()
+
+    def test_decryption_is_memoized(self):
+        mobileapp = MobileApp.objects.get(pk=self.mobileapp.pk)
+        self.assertEqual(mobileapp.provider_key, 'test key')
+        self.assertEqual(mobileapp.provider_secret, 'test secret')
+        self.assertEqual(decrypt_value.cache_info().misses, 2)
+
+        mobileapp = MobileApp.objects.get(pk=self.mobileapp.pk)
+        self.assertEqual(mobileapp.provider_key, 'test key')
+        self.assertEqual(mobileapp.provider_secret, 'test secret')
+        self.assertEqual(decrypt_value.cache_info().misses, 2)
+        self.assertEqual(decrypt_value.cache_info().hits, 2)
+
+    def test_decryption_is_lazy(self):
+        mobileapps = list(MobileApp.objects.all())
+        self.assertEqual(mobileapps[0].name, 'Test App')
+        self.assertEqual(decrypt_value.cache_info().currsize, 0)
+
+        self.assertEqual(mobileapps[0].get_api_keys(), {
+            'provider_key': 'test key',
+            'provider_secret': 'test secret',
+        })
+        self.assertEqual(decrypt_value.cache_info().currsize, 2)
+
+    def test_add_members_reports_new_members_only(self):
+        users = UserFactory.create_batch(3)
+        self.mobileapp.users.add(users[0])
+        pk_sets = []
+
+        def receiver(action, pk_set, **kwargs):  # pylint: disable=unused-argument
+            if action == 'post_add':
+                pk_sets.append(pk_set)
+
+        m2m_changed.connect(receiver, sender=MobileApp.users.through)
+        try:
+            added = add_members(self.mobileapp, 'users', [user.id for user in users] + [0])
+        finally:
+            m2m_changed.disconnect(receiver, sender=MobileApp.users.through)
+        self.assertEqual(added, 2)
+        self.assertEqual(pk_sets, [{users[1].id, users[2].id}])
+
+    def test_member_changes_bump_generations(self):
+        names = [MOBILE_APPS_GENERATION, get_mobile_app_generation_name(self.mobileapp.id)]
+        generations = get_generations(names)
+
+        self.mobileapp.users.add(UserFactory.create())
+        new_generations = get_generations(names)
+        for generation, new_generation in zip(generations, new_generations):
+            self.assertGreater(new_generation, generation)
+
+        organization = Organization.objects.create(name='Test Organization')
+        organization.mobile_apps.add(self.mobileapp)
+        self.assertGreater(get_generations(names)[1], new_generations[1])
+
+    def test_user_organization_ids_are_cached(self):
+        organization = Organization.objects.create(name='Test Organization')
+        organization.users.add(self.user)
+        self.assertEqual(get_user_organization_ids(self.user), [organization.id])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_organization_ids(self.user), [organization.id])
+
+        other_organization = Organization.objects.create(name='Other Organization')
+        self.user.organizations.add(other_organization)
+        self.assertEqual(sorted(get_user_organization_ids(self.user)), sorted([organization.id, other_organization.id]))
+
+        organization.users.clear()
+        self.assertEqual(get_user_organization_ids(self.user), [other_organization.id])
+
+    def test_reencrypt_provider_credentials(self):
+        with patch('mobileapps.models.StringCipher', RotatedStringCipher), \
+                patch('mobileapps.management.commands.reencrypt_provider_credentials.StringCipher',
+                      RotatedStringCipher):
+            call_command('reencrypt_provider_credentials', chunk_size=1, batch_size=1)
+            decrypt_value.cache_clear()
+
+            mobileapp = MobileApp.objects.get(pk=self.mobileapp.pk)
+            self.assertEqual(mobileapp.provider_key, 'test key')
+            self.assertEqual(mobileapp.provider_secret, 'test secret')
+            history = MobileAppHistory.objects.get()
+            self.assertEqual(history.provider_key, 'test key')
+            self.assertEqual(history.provider_secret, 'test secret')
+
+    def test_reencrypt_provider_credentials_resumes_after_crash(self):
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        with patch('mobileapps.models.StringCipher', RotatedStringCipher), \
+                patch('mobileapps.management.commands.reencrypt_provider_credentials.StringCipher',
+                      RotatedStringCipher):
+            # The process dies after the first chunk is committed, before it is checkpointed.
+            with patch.object(Checkpoint, 'mark_done', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    call_command('reencrypt_provider_credentials', chunk_size=1, checkpoint=checkpoint_path)
+
+            call_command('reencrypt_provider_credentials', chunk_size=1, checkpoint=checkpoint_path)
+            decrypt_value.cache_clear()
+
+            mobileapp = MobileApp.objects.get(pk=self.mobileapp.pk)
+            self.assertEqual(mobileapp.provider_key, 'test key')
+            self.assertEqual(mobileapp.provider_secret, 'test secret')
+            history = MobileAppHistory.objects.get()
+            self.assertEqual(history.provider_key, 'test key')
+
+    def test_history_reuses_ciphertext(self):
+        with patch.object(StringCipher, 'encrypt', wraps=StringCipher.encrypt) as mock_encrypt:
+            mobileapp = MobileApp.objects.create(
+                name='Another App',
+                current_version='1',
+                provider_key='another key',
+                provider_secret='another secret',
+                updated_by=self.user,
+            )
+            self.assertEqual(mock_encrypt.call_count, 2)
+
+            mobileapp = MobileApp.objects.get(pk=mobileapp.pk)
+            mobileapp.current_version = '2'
+            mobileapp.save()
+            self.assertEqual(mock_encrypt.call_count, 2)
+
+        history = MobileAppHistory.objects.filter(name='Another App').order_by('-id')[0]
+        self.assertEqual(history.current_version, '2')
+        self.assertEqual(history.provider_key, 'another key')
+        self.assertEqual(history.provider_secret, 'another secret')
+
+    def test_history_recorded_only_on_changes(self):
+        self.assertEqual(MobileAppHistory.objects.count(), 1)
+
+        mobileapp = MobileApp.objects.get(pk=self.mobileapp.pk)
+        mobileapp.updated_by = UserFactory.create()
+        mobileapp.save()
+        mobileapp.provider_key = 'test key'
+        mobileapp.save()
+        self.assertEqual(MobileAppHistory.objects.count(), 1)
+
+        mobileapp.provider_key = 'new key'
+        mobileapp.save()
+        self.assertEqual(MobileAppHistory.objects.count(), 2)
+        mobileapp.save()
+        self.assertEqual(MobileAppHistory.objects.count(), 2)
+
+    def test_history_written_on_commit(self):
+        with transaction.atomic():
+            for version in range(3):
+                self.mobileapp.current_version = str(version + 2)
+                self.mobileapp.save()
+            self.assertEqual(MobileAppHistory.objects.count(), 1)
+
+        self.assertEqual(MobileAppHistory.objects.count(), 4)
+
+        try:
+            with transaction.atomic():
+                self.mobileapp.current_version = '10'
+                self.mobileapp.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(MobileAppHistory.objects.count(), 4)
+
+        with transaction.atomic():
+            self.mobileapp.current_version = '11'
+            self.mobileapp.save()
+        self.assertEqual(MobileAppHistory.objects.count(), 5)
+
+        with transaction.atomic():
+            self.mobileapp.current_version = '12'
+            self.mobileapp.save()
+            try:
+                with transaction.atomic():
+                    self.mobileapp.current_version = '13'
+                    self.mobileapp.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            self.mobileapp.current_version = '14'
+            self.mobileapp.save()
+        self.assertEqual(
+            list(MobileAppHistory.objects.order_by('-id').values_list('current_version', flat=True)[:2]),
+            ['14', '12'],
+        )
+        self.assertEqual(MobileAppHistory.objects.count(), 7)
+
+        with transaction.atomic():
+            self.mobileapp.current_version = '15'
+            self.mobileapp.save()
+            with transaction.atomic():
+                self.mobileapp.current_version = '16'
+                self.mobileapp.save()
+            self.mobileapp.current_version = '17'
+            self.mobileapp.save()
+        self.assertEqual(
+            list(MobileAppHistory.objects.order_by('-id').values_list('current_version', flat=True)[:3]),
+            ['17', '16', '15'],
+        )
+
+    @override_settings(MOBILEAPPS_HISTORY_ASYNC=True)
+    def test_history_written_by_task(self):
+        with patch('mobileapps.tasks.record_mobile_app_history_task.delay') as mock_delay:
+            with transaction.atomic():
+                self.mobileapp.current_version = '2'
+                self.mobileapp.save()
+                self.mobileapp.current_version = '3'
+                self.mobileapp.save()
+
+        self.assertEqual(mock_delay.call_count, 1)
+        records = mock_delay.call_args[0][0]
+        self.assertEqual([record['current_version'] for record in records], ['2', '3'])
+        self.assertTrue(records[0]['provider_key'].startswith('enc_str__'))
+
+    def test_prune_history(self):
+        now = datetime.datetime(2018, 6, 1, 12, tzinfo=UTC)
+        MobileAppHistory.objects.all().delete()
+
+        def create_history(days_ago, hours_ago=0):
+            return MobileAppHistory.objects.create(
+                mobile_app=self.mobileapp,
+                name=self.mobileapp.name,
+                current_version=str(days_ago),
+                deployment_mechanism=self.mobileapp.deployment_mechanism,
+                updated_by=self.user,
+                created=now - datetime.timedelta(days=days_ago, hours=hours_ago),
+            )
+
+        recent = [create_history(1), create_history(1, 1)]
+        daily = [create_history(40, 2), create_history(40, 1)]
+        expired = [create_history(400, 1), create_history(400)]
+
+        result = prune_mobile_app_history(now=now, batch_size=1)
+
+        self.assertEqual(result['compacted'], 1)
+        self.assertEqual(result['dropped'], 2)
+        self.assertEqual(
+            set(MobileAppHistory.objects.values_list('id', flat=True)),
+            {recent[0].id, recent[1].id, daily[1].id},
+        )
+        self.assertFalse(MobileAppHistory.objects.filter(id__in=[record.id for record in expired]).exists())
@@ -0,0 +1,128 @@
+"""
+Rate limiting of the calls made to push notification providers.
+
+Calls are counted per provider and API key in the shared cache, so the limit holds
+across all Celery workers. A provider limited to `rate` calls per second with bursts
+of `burst` calls allows `burst // 2` calls per window of `burst // 2 / rate` seconds.
+Calls at the end of one window and the start of the next add up to at most `burst`,
+so this stays within the bounds of a token bucket (no more than `burst + rate * t`
+calls in any `t` seconds) with the atomic operations every cache backend offers.
+A burst of 1 still allows one call per window, i.e. up to 2 calls back to back.
+"""
+import hashlib
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+# Calls per second and burst size of the providers missing from MOBILEAPPS_NOTIFICATION_RATE_LIMITS.
+DEFAULT_RATE_LIMIT = (10, 10)
+
+RATE_LIMIT_CACHE_KEY = 'mobileapps.ratelimit.{}.{}.{}'
+METRICS_CACHE_KEY = 'mobileapps.ratelimit.metrics.{}.{}'
+
+ALLOWED = 'allowed'
+THROTTLED = 'throttled'
+RETRIED = 'retried'
+DROPPED = 'dropped'
+EVENTS = (ALLOWED, THROTTLED, RETRIED, DROPPED)
+
+# HTTP statuses of provider responses worth retrying: throttled, or the provider is unavailable.
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def get_rate_limit(provider):
+    """
+    Returns the `(rate, burst)` of a provider; a falsy rate disables its limit.
+    """
+    rate_limits = getattr(settings, 'MOBILEAPPS_NOTIFICATION_RATE_LIMITS', {})
+    return rate_limits.get(provider, getattr(settings, 'MOBILEAPPS_NOTIFICATION_RATE_LIMIT', DEFAULT_RATE_LIMIT))
+
+
+def record_rate_limit_event(provider, event):
+    """
+    Counts a rate limiting decision or outcome of a provider in the shared cache.
+    """
+    key = METRICS_CACHE_KEY.format(provider, event)
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, None)
+
+
+def get_rate_limit_metrics(provider):
+    """
+    Returns the number of calls to a provider allowed, throttled, retried and dropped, keyed by event.
+    """
+    keys = {event: METRICS_CACHE_KEY.format(provider, event) for event in EVENTS}
+    counts = cache.get_many(list(keys.values()))
+    return {event: counts.get(key, 0) for event, key in keys.items()}
+
+
+def acquire_notification_slot(provider, api_keys, now=None):
+    """
+    Takes one call from the allowance of a provider and API key.
+
+    Returns 0 when the call may go ahead, otherwise the number of seconds until
+    the allowance is renewed.
+    """
+    rate, burst = get_rate_limit(provider)
+    if not rate:
+        return 0
+
+    allowance = max(burst // 2, 1)
+    window = allowance / rate
+    now = time.time() if now is None else now
+    window_number = int(now // window)
+    api_key = str((api_keys or {}).get('provider_key') or '')
+    key = RATE_LIMIT_CACHE_KEY.format(
+        provider, hashlib.sha1(api_key.encode('utf-8')).hexdigest(), window_number,
+    )
+
+    timeout = int(window) + 1
+    cache.add(key, 0, timeout)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # The window expired in between, so this call is the first of the next one,
+        # unless another call started it first.
+        count = 1
+        if not cache.add(key, count, timeout):
+            count = cache.incr(key)
+
+    if count <= allowance:
+        record_rate_limit_event(provider, ALLOWED)
+        return 0
+
+    record_rate_limit_event(provider, THROTTLED)
+    log.info('Throttled call to notification provider %s', provider)
+    return (window_number + 1) * window - now
+
+
+def is_transient_error(error):
+    """
+    Tells whether a failed call to a provider is worth retrying, i.e. it was
+    throttled, the provider was unavailable, or it could not be reached.
+
+    HTTP errors carry the provider response, as `requests` exceptions do, and are
+    told apart by its status. Connection errors and timeouts are `OSError`s.
+    """
+    status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status_code is not None:
+        return status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, OSError) and not isinstance(error, ValueError)
+
+
+def get_retry_countdown(retries, minimum=0):
+    """
+    Returns the seconds to wait before a retry, drawn at random up to an exponentially
+    growing cap ("full jitter"), and no less than `minimum`.
+    """
+    base = getattr(settings, 'MOBILEAPPS_NOTIFICATION_RETRY_BACKOFF', 2)
+    cap = getattr(settings, 'MOBILEAPPS_NOTIFICATION_RETRY_BACKOFF_MAX', 300)
+    return max(minimum, random.uniform(0, min(cap, base * 2 ** retries)))
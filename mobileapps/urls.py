@@ -5,7 +5,13 @@ urlpatterns = [
     url(r'^notification_providers$', mobile_views.NotificationProviderView.as_view(), name='notification_providers'),
     url(r'^$', mobile_views.MobileAppView.as_view(), name='mobileapps'),
     url(r'^(?P<pk>[0-9]+)$', mobile_views.MobileAppDetailView.as_view(), name='mobileapps-detail'),
+    url(r'^(?P<mobile_app_id>[0-9]+)/history$', mobile_views.MobileAppHistoryView.as_view(),
+        name='mobileapps-history'),
     url(r'^(?P<mobile_app_id>[0-9]+)/users$', mobile_views.MobileAppUserView.as_view(), name='mobileapps-users'),
+    url(r'^(?P<mobile_app_id>[0-9]+)/users/imports$', mobile_views.MobileAppUserImportView.as_view(),
+        name='mobileapps-users-imports'),
+    url(r'^(?P<mobile_app_id>[0-9]+)/users/imports/(?P<import_id>[0-9]+)$',
+        mobile_views.MobileAppUserImportDetailView.as_view(), name='mobileapps-users-imports-detail'),
     url(r'^(?P<mobile_app_id>[0-9]+)/organizations$',
         mobile_views.MobileAppOrganizationView.as_view(), name='mobileapps-organizations'),
     url(r'^notification$', mobile_views.MobileAppsNotifications.as_view(), name='mobileapps-notifications'),
@@ -1,16 +1,21 @@
 import datetime
+import hashlib
+import json
+import os
+import uuid
 from contextlib import closing
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.storage import default_storage
 from django.db import transaction
+from django.db.models import Prefetch
 from django.http import Http404
 from django.shortcuts import get_object_or_404
-from django.utils.timezone import utc
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, utc
 from django.utils.translation import ugettext_lazy as _
-from edx_notifications.data import NotificationMessage
-from edx_notifications.lib.publisher import get_notification_type
 from edx_solutions_api_integration.permissions import (
     IsStaffOrReadOnlyView, IsStaffView, MobileAPIView, MobileListAPIView,
     MobileListCreateAPIView, MobileRetrieveUpdateAPIView,
@@ -19,12 +24,34 @@ from edx_solutions_api_integration.users.serializers import SimpleUserSerializer
 from edx_solutions_api_integration.utils import get_ids_from_list_param
 from edx_solutions_organizations.models import Organization
 from edx_solutions_organizations.serializers import BasicOrganizationSerializer
+from mobileapps.caching import (MOBILE_APPS_GENERATION, ConditionalGetMixin,
+                                IdempotentPostMixin, ReadThroughCache,
+                                get_mobile_app_generation_name)
 from mobileapps.image_helpers import get_image_names
-from mobileapps.models import MobileApp, NotificationProvider, Theme
-from mobileapps.serializers import (MobileAppSerializer,
+from mobileapps.membership import (add_members, chunked, get_member_ids,
+                                   remove_members, sync_members)
+from mobileapps.models import (EncryptedCharField, EncryptedValue, MobileApp,
+                               MobileAppHistory, MobileAppNotificationSend,
+                               MobileAppUserImport, NotificationProvider,
+                               Theme)
+from mobileapps.pagination import (CursorPaginationMixin, HistoryPagination,
+                                   ThemePagination)
+from mobileapps.scoping import (filter_mobile_apps_by_organization_name,
+                                filter_mobile_apps_by_organizations,
+                                scope_mobile_apps, scope_organizations,
+                                scope_themes, scope_users)
+from mobileapps.serializers import (MobileAppHistorySerializer,
+                                    MobileAppSerializer,
+                                    MobileAppUserImportSerializer,
                                     NotificationProviderSerializer,
-                                    ThemeSerializer)
-from mobileapps.tasks import publish_mobile_apps_notifications_task
+                                    ThemeSerializer, get_expanded_fields,
+                                    get_requested_fields)
+from mobileapps.tasks import (create_notification_message,
+                              dispatch_mobile_apps_notifications,
+                              get_notification_batch_size,
+                              import_mobile_app_users_task,
+                              publish_mobile_apps_notifications_task,
+                              publish_organization_notifications_task)
 from openedx.core.djangoapps.profile_images.exceptions import ImageValidationError
 from openedx.core.djangoapps.profile_images.images import (
     IMAGE_TYPES, validate_uploaded_image)
@@ -53,7 +80,67 @@ def _save_theme_image(uploaded_image, image_sizes, name_key, image_backend):
         return True, None
 
 
-class NotificationProviderView(MobileListAPIView):
+def _get_mobile_app_queryset(request):
+    """
+    Returns the mobile apps with what the request serializes: all columns and member
+    counts by default, only the requested ones with `?fields=`, and the member ids
+    when the request expands users or organizations.
+    """
+    queryset = MobileApp.objects.all()
+    expanded_fields = get_expanded_fields(request)
+    requested_fields = get_requested_fields(request)
+    if requested_fields is None:
+        queryset = queryset.with_member_counts()
+    else:
+        expanded_fields |= requested_fields
+        if requested_fields & {'user_count', 'organization_count'}:
+            queryset = queryset.with_member_counts()
+        columns = [field.name for field in MobileApp._meta.concrete_fields if field.name in requested_fields]
+        queryset = queryset.only('id', *columns)
+
+    if 'users' in expanded_fields:
+        queryset = queryset.prefetch_related(Prefetch('users', queryset=User.objects.only('id')))
+    if 'organizations' in expanded_fields:
+        queryset = queryset.prefetch_related(Prefetch('organizations', queryset=Organization.objects.only('id')))
+    return queryset
+
+
+# Serialized mobile app details, kept until the app or its members change.
+mobile_app_detail_cache = ReadThroughCache(
+    'mobileapps.detail',
+    timeout=getattr(settings, 'MOBILEAPPS_DETAIL_CACHE_TIMEOUT', 60 * 60),
+    local_timeout=getattr(settings, 'MOBILEAPPS_DETAIL_CACHE_LOCAL_TIMEOUT', 5),
+    local_size=getattr(settings, 'MOBILEAPPS_DETAIL_CACHE_LOCAL_SIZE', 1024),
+)
+
+
+def _seal_encrypted_fields(mobile_app, data):
+    """
+    Returns serialized mobile app data fit for the shared cache, with the provider
+    credentials replaced by their ciphertexts.
+    """
+    data = dict(data)
+    encrypted = {}
+    for field in MobileApp._meta.concrete_fields:
+        if isinstance(field, EncryptedCharField) and field.name in data:
+            value = field.get_stored_value(mobile_app)
+            if isinstance(value, EncryptedValue):
+                encrypted[field.name] = value.ciphertext
+                data[field.name] = None
+    return {'data': data, 'encrypted': encrypted}
+
+
+def _unseal_encrypted_fields(sealed):
+    """
+    Returns the serialized mobile app data sealed by `_seal_encrypted_fields`.
+    """
+    data = dict(sealed['data'])
+    for name, ciphertext in sealed['encrypted'].items():
+        data[name] = EncryptedValue(ciphertext).plaintext
+    return data
+
+
+class NotificationProviderView(CursorPaginationMixin, MobileListAPIView):
     """
     **Use Case**
 
@@ -62,6 +149,7 @@ class NotificationProviderView(MobileListAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/notification_providers
+        GET /api/server/mobileapps/notification_providers?cursor={cursor}
 
     **Response Values**
 
@@ -70,6 +158,8 @@ class NotificationProviderView(MobileListAPIView):
         If the request is successful, the request returns an HTTP 200 "OK" response.
 
         The HTTP 200 response has a paginated list of objects with the following values.
+        With `cursor`, empty for the first page, the list is ordered by id and has
+        `next` and `previous` cursor links instead of `count` and `num_pages`.
 
         * id: ID of the notification provider.
         * name: Name of provider.
@@ -81,7 +171,7 @@ class NotificationProviderView(MobileListAPIView):
     queryset = NotificationProvider.objects.all()
 
 
-class MobileAppView(MobileListCreateAPIView):
+class MobileAppView(ConditionalGetMixin, CursorPaginationMixin, MobileListCreateAPIView):
     """
     **Use Case**
 
@@ -90,6 +180,9 @@ class MobileAppView(MobileListCreateAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/
+        GET /api/server/mobileapps/?expand=users,organizations
+        GET /api/server/mobileapps/?fields=name,current_version,ios_download_url
+        GET /api/server/mobileapps/?cursor={cursor}
         POST /api/server/mobileapps/
 
         **POST Parameters**
@@ -125,6 +218,8 @@ class MobileAppView(MobileListCreateAPIView):
         If the request is successful, the request returns an HTTP 200 "OK" response.
 
         The HTTP 200 response has a paginated list of objects with the following values.
+        With `cursor`, empty for the first page, the list is ordered by id and has
+        `next` and `previous` cursor links instead of `count` and `num_pages`.
 
         * id: ID of the mobile app.
         * created: Datetime it was created in.
@@ -148,8 +243,15 @@ class MobileAppView(MobileListCreateAPIView):
         * current_version: Current available version of the app
         * is_active: App is active or not.
         * updated_by: Record updated by the User.
-        * users: List of user ids registered in the app
-        * organizations: List of organization ids in this app
+        * user_count: Number of users registered in the app
+        * organization_count: Number of organizations in this app
+        * users: List of user ids registered in the app, only with `expand=users`
+        * organizations: List of organization ids in this app, only with `expand=organizations`
+
+        A GET with `fields` returns only `id` and the listed fields.
+
+        GET responses carry `ETag` and `Last-Modified` headers. A GET whose `If-None-Match`
+        or `If-Modified-Since` header matches them returns an HTTP 304 "Not Modified" response.
 
         **POST**
 
@@ -177,8 +279,10 @@ class MobileAppView(MobileListCreateAPIView):
         * current_version: Current available version of the app
         * is_active: App is active or not.
         * updated_by: Record updated by the User.
-        * users: List of user ids registered in the app
-        * organizations: List of organization ids in this app
+        * user_count: Number of users registered in the app
+        * organization_count: Number of organizations in this app
+        * users: List of user ids registered in the app, only with `expand=users`
+        * organizations: List of organization ids in this app, only with `expand=organizations`
     """
 
     serializer_class = MobileAppSerializer
@@ -191,7 +295,18 @@ class MobileAppView(MobileListCreateAPIView):
         Optionally restricts the returned mobile apps to a given user,
         by filtering against a 'app name' or 'organization name' query parameter in the URL.
         """
-        queryset = MobileApp.objects.all()
+        return self.filter_mobile_apps(_get_mobile_app_queryset(self.request))
+
+    def get_conditional_queryset(self):
+        return self.filter_mobile_apps(MobileApp.objects.all())
+
+    def get_generation_names(self):
+        return [MOBILE_APPS_GENERATION]
+
+    def filter_mobile_apps(self, queryset):
+        """
+        Applies the query parameter filters and the requester's scope to mobile apps.
+        """
         app_name = self.request.query_params.get('app_name', None)
         organization_name = self.request.query_params.get('organization_name', None)
         organization_ids = get_ids_from_list_param(self.request, 'organization_ids')
@@ -200,19 +315,15 @@ class MobileAppView(MobileListCreateAPIView):
             queryset = queryset.filter(name__icontains=app_name)
 
         if organization_name is not None:
-            queryset = queryset.filter(organizations__name__icontains=organization_name)
+            queryset = filter_mobile_apps_by_organization_name(queryset, organization_name)
 
         if organization_ids is not None:
-            queryset = queryset.filter(organizations__in=organization_ids).distinct()
-
-        if not self.request.user.is_staff:
-            user_organizations = self.request.user.organizations.all()
-            queryset = queryset.filter(organizations__in=user_organizations).distinct()
+            queryset = filter_mobile_apps_by_organizations(queryset, organization_ids)
 
-        return queryset
+        return scope_mobile_apps(queryset, self.request.user)
 
 
-class MobileAppDetailView(MobileRetrieveUpdateAPIView):
+class MobileAppDetailView(ConditionalGetMixin, MobileRetrieveUpdateAPIView):
     """
     **Use Case**
 
@@ -221,6 +332,9 @@ class MobileAppDetailView(MobileRetrieveUpdateAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/{id}
+        GET /api/server/mobileapps/{id}?expand=users,organizations
+        GET /api/server/mobileapps/{id}?fields=name,current_version,ios_download_url
+        GET /api/server/mobileapps/{id}?as_of=2017-12-29T07:20:00Z
         PUT /api/server/mobileapps/{id}
         PATCH /api/server/mobileapps/{id}
 
@@ -279,8 +393,21 @@ class MobileAppDetailView(MobileRetrieveUpdateAPIView):
         * current_version: Current available version of the app
         * is_active: App is active or not.
         * updated_by: Record updated by the User.
-        * users: List of user ids registered in the app
-        * organizations: List of organization ids in this app
+        * user_count: Number of users registered in the app
+        * organization_count: Number of organizations in this app
+        * users: List of user ids registered in the app, only with `expand=users`
+        * organizations: List of organization ids in this app, only with `expand=organizations`
+
+        A GET with `fields` returns only `id` and the listed fields.
+
+        GET responses carry `ETag` and `Last-Modified` headers. A GET whose `If-None-Match`
+        or `If-Modified-Since` header matches them returns an HTTP 304 "Not Modified" response.
+
+        **GET with as_of**
+
+        Returns the app as it was configured at the given ISO 8601 datetime, with the
+        fields of its history record (see /api/server/mobileapps/{id}/history).
+        Returns an HTTP 404 response if the app has no history before that time.
     """
 
     serializer_class = MobileAppSerializer
@@ -293,16 +420,112 @@ class MobileAppDetailView(MobileRetrieveUpdateAPIView):
         Optionally restricts the returned mobile apps to a given user,
         by filtering against a 'app name' or 'organization name' query parameter in the URL.
         """
-        queryset = MobileApp.objects.all()
+        queryset = _get_mobile_app_queryset(self.request)
+        return scope_mobile_apps(queryset, self.request.user)
+
+    def get_conditional_queryset(self):
+        return scope_mobile_apps(MobileApp.objects.filter(pk=self.kwargs['pk']), self.request.user)
+
+    def get_generation_names(self):
+        return [get_mobile_app_generation_name(self.kwargs['pk'])]
+
+    def retrieve(self, request, *args, **kwargs):
+        as_of = request.query_params.get('as_of', None)
+        if as_of is None:
+            return Response(self.get_cached_representation())
+
+        try:
+            timestamp = parse_datetime(as_of)
+        except ValueError:
+            # Well formed but impossible, e.g. month 13.
+            timestamp = None
+        if timestamp is None:
+            return Response({'message': _('as_of must be an ISO 8601 datetime')}, status.HTTP_400_BAD_REQUEST)
+        if is_naive(timestamp):
+            timestamp = make_aware(timestamp, utc)
+
+        mobile_app = self.get_object()
+        snapshot = MobileAppHistory.objects.snapshot(mobile_app.id, timestamp)
+        if snapshot is None:
+            raise Http404
+        return Response(MobileAppHistorySerializer(snapshot).data)
+
+    def get_cached_representation(self):
+        """
+        Returns the serialized mobile app from `mobile_app_detail_cache`, which is keyed
+        by app and by the `expand` and `fields` the serializer honours.
+        """
+        mobile_app_id = self.kwargs['pk']
+        if not self.request.user.is_staff and not self.get_conditional_queryset().exists():
+            raise Http404
+
+        requested_fields = get_requested_fields(self.request)
+        variant = (
+            sorted(get_expanded_fields(self.request)),
+            None if requested_fields is None else sorted(requested_fields),
+        )
+        key = '{}.{}'.format(mobile_app_id, hashlib.md5(repr(variant).encode('utf-8')).hexdigest())
+
+        def serialize():
+            mobile_app = self.get_object()
+            return _seal_encrypted_fields(mobile_app, self.get_serializer(mobile_app).data)
+
+        sealed = mobile_app_detail_cache.get(key, [get_mobile_app_generation_name(mobile_app_id)], serialize)
+        return _unseal_encrypted_fields(sealed)
+
 
-        if not self.request.user.is_staff:
-            user_organizations = self.request.user.organizations.all()
-            queryset = queryset.filter(organizations__in=user_organizations).distinct()
+class MobileAppHistoryView(MobileListAPIView):
+    """
+    **Use Case**
+
+        Get the change history of a mobile app, newest first.
+
+    **Example Requests**
+
+        GET /api/server/mobileapps/{id}/history
+        GET /api/server/mobileapps/{id}/history?cursor={cursor}
+
+    **Response Values**
+
+        **GET**
+
+        If the request is successful, the request returns an HTTP 200 "OK" response.
+
+        The HTTP 200 response has a page of objects under `results`, with `next`
+        and `previous` links carrying the cursor of the adjacent pages.
+
+        * id: ID of the history record.
+        * mobile_app: ID of the mobile app.
+        * created: Datetime the change was recorded.
+        * name: Name of the app,
+        * ios_app_id: ios app ID
+        * ios_bundle_id: ios app's bundle ID
+        * android_app_id: Android app ID
+        * ios_download_url: IOS Download URL of the app.
+        * android_download_url: Android Download URL of the app.
+        * deployment_mechanism: Deployment Mechanism
+        * analytics_url: Analytics url
+        * notification_provider: Notification provider selected for this app
+        * provider_dashboard_url: Provider dashboard URL
+        * current_version: Current available version of the app
+        * is_active: App is active or not.
+        * updated_by: Record updated by the User.
+    """
+    serializer_class = MobileAppHistorySerializer
+    pagination_class = HistoryPagination
+
+    def __init__(self):
+        self.permission_classes += (IsStaffView,)
 
-        return queryset
+    def get_queryset(self):
+        """
+        Restricts the returned history to a given mobile app,
+        by filtering against a 'mobile_app_id' in kwargs.
+        """
+        return MobileAppHistory.objects.filter(mobile_app_id=self.kwargs['mobile_app_id'])
 
 
-class MobileAppUserView(MobileListAPIView):
+class MobileAppUserView(CursorPaginationMixin, MobileListAPIView):
     """
     **Use Case**
 
@@ -311,7 +534,9 @@ class MobileAppUserView(MobileListAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/{id}/users
+        GET /api/server/mobileapps/{id}/users?cursor={cursor}
         POST /api/server/mobileapps/{id}/users
+        PUT /api/server/mobileapps/{id}/users
         DELETE /api/server/mobileapps/{id}/users
     """
     serializer_class = SimpleUserSerializer
@@ -325,11 +550,7 @@ class MobileAppUserView(MobileListAPIView):
         by filtering against a 'mobile_app_id' in kwargs.
         """
         queryset = User.objects.filter(mobile_apps__exact=self.kwargs['mobile_app_id'])
-        if not self.request.user.is_staff:
-            user_organizations = self.request.user.organizations.all()
-            queryset = queryset.filter(organizations__in=user_organizations)
-
-        return queryset
+        return scope_users(queryset, self.request.user)
 
     def post(self, request, mobile_app_id):
         """
@@ -344,9 +565,8 @@ class MobileAppUserView(MobileListAPIView):
             If the request is successful, the request returns an HTTP 201 "CREATED" response.
         """
         try:
-            mobileapp = MobileApp.objects.get(id=mobile_app_id)
-            for user in User.objects.filter(id__in=request.data['users']):
-                mobileapp.users.add(user)
+            mobileapp = MobileApp.objects.only('id').get(id=mobile_app_id)
+            add_members(mobileapp, 'users', request.data['users'])
 
             return Response({}, status=status.HTTP_201_CREATED)
         except ObjectDoesNotExist:
@@ -365,16 +585,129 @@ class MobileAppUserView(MobileListAPIView):
             If the request is successful, the request returns an HTTP 204 "NO CONTENT" response.
         """
         try:
-            mobileapp = MobileApp.objects.get(id=mobile_app_id)
-            for user in User.objects.filter(id__in=request.data['users']):
-                mobileapp.users.remove(user)
+            mobileapp = MobileApp.objects.only('id').get(id=mobile_app_id)
+            remove_members(mobileapp, 'users', request.data['users'])
 
             return Response({}, status=status.HTTP_204_NO_CONTENT)
         except ObjectDoesNotExist:
             raise Http404
 
+    def put(self, request, mobile_app_id):
+        """
+        **PUT Parameters**
+
+            The body of the PUT request must include the following parameters.
+
+            * users: list of all the user ids the mobile app should have, other users are removed
 
-class MobileAppOrganizationView(MobileListAPIView):
+        **Response Values**
+
+            If the request is successful, the request returns an HTTP 200 "OK" response.
+
+            * added: Number of users added to the mobile app
+            * removed: Number of users removed from the mobile app
+        """
+        user_ids = request.data.get('users', None)
+        if not isinstance(user_ids, list):
+            return Response({'message': _('users must be a list of ids')}, status.HTTP_400_BAD_REQUEST)
+
+        mobileapp = get_object_or_404(MobileApp.objects.only('id'), pk=mobile_app_id)
+        try:
+            added, removed = sync_members(mobileapp, 'users', user_ids)
+        except (TypeError, ValueError):
+            return Response({'message': _('users must be a list of ids')}, status.HTTP_400_BAD_REQUEST)
+
+        return Response({'added': added, 'removed': removed}, status=status.HTTP_200_OK)
+
+
+class MobileAppUserImportView(MobileAPIView):
+    """
+    **Use Case**
+
+        Add users to a mobile app in bulk, from an uploaded file processed in the background.
+
+    **Example Requests**
+
+        POST /api/server/mobileapps/{id}/users/imports
+
+        **POST Parameters**
+
+        The body of the POST request must be multipart and include the following parameters.
+
+        * file: CSV file with a user id, username or email in the first column of each row,
+          or NDJSON file with a user id, username or email per line, as a plain value or as
+          an object with an `id`, `user_id`, `username` or `email` key
+        * format: `csv` or `ndjson` (Optional, taken from the file extension by default)
+
+    **Response Values**
+
+        If the request is successful, the request returns an HTTP 202 "Accepted" response
+        with the import job, see GET /api/server/mobileapps/{id}/users/imports/{import_id}.
+    """
+    def __init__(self):
+        self.permission_classes += (IsStaffView,)
+
+    def post(self, request, mobile_app_id):
+        uploaded_file = request.FILES.get('file', None)
+        if not uploaded_file:
+            return Response({'message': _('file is missing')}, status.HTTP_400_BAD_REQUEST)
+
+        file_format = request.data.get('format', None) or os.path.splitext(uploaded_file.name)[1][1:].lower()
+        file_format = 'ndjson' if file_format == 'jsonl' else file_format
+        if file_format not in dict(MobileAppUserImport.FORMAT_CHOICES):
+            return Response({'message': _('format must be csv or ndjson')}, status.HTTP_400_BAD_REQUEST)
+
+        mobile_app = get_object_or_404(MobileApp.objects.only('id'), pk=mobile_app_id)
+        file_name = default_storage.save(
+            'mobileapps/user_imports/{}.{}'.format(uuid.uuid4().hex, file_format), uploaded_file
+        )
+        user_import = MobileAppUserImport.objects.create(
+            mobile_app=mobile_app,
+            created_by=request.user,
+            file_name=file_name,
+            file_format=file_format,
+        )
+        transaction.on_commit(lambda: import_mobile_app_users_task.delay(user_import.id))
+
+        return Response(MobileAppUserImportSerializer(user_import).data, status.HTTP_202_ACCEPTED)
+
+
+class MobileAppUserImportDetailView(MobileAPIView):
+    """
+    **Use Case**
+
+        Get the progress of a bulk user import into a mobile app.
+
+    **Example Requests**
+
+        GET /api/server/mobileapps/{id}/users/imports/{import_id}
+
+    **Response Values**
+
+        If the request is successful, the request returns an HTTP 200 "OK" response.
+
+        * id: ID of the import.
+        * mobile_app: ID of the mobile app.
+        * created_by: User who uploaded the file.
+        * file_format: `csv` or `ndjson`
+        * status: `pending`, `running`, `completed` or `failed`
+        * processed_count: Number of identifiers processed so far.
+        * failed_count: Number of processed identifiers which matched no user.
+        * throughput: Identifiers processed per second.
+        * started_at: Datetime the import started.
+        * finished_at: Datetime the import finished.
+        * created: Datetime it was created in.
+        * modified: Datetime it was modified in.
+    """
+    def __init__(self):
+        self.permission_classes += (IsStaffView,)
+
+    def get(self, request, mobile_app_id, import_id):
+        user_import = get_object_or_404(MobileAppUserImport, pk=import_id, mobile_app_id=mobile_app_id)
+        return Response(MobileAppUserImportSerializer(user_import).data)
+
+
+class MobileAppOrganizationView(CursorPaginationMixin, MobileListAPIView):
     """
     **Use Case**
 
@@ -383,7 +716,9 @@ class MobileAppOrganizationView(MobileListAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/{id}/organizations
+        GET /api/server/mobileapps/{id}/organizations?cursor={cursor}
         POST /api/server/mobileapps/{id}/organizations
+        PUT /api/server/mobileapps/{id}/organizations
         DELETE /api/server/mobileapps/{id}/organizations
     """
     serializer_class = BasicOrganizationSerializer
@@ -397,9 +732,7 @@ class MobileAppOrganizationView(MobileListAPIView):
         by filtering against a 'mobile_app_id' in kwargs.
         """
         queryset = Organization.objects.filter(mobile_apps__exact=self.kwargs['mobile_app_id'])
-        if not self.request.user.is_staff:
-            queryset = queryset.filter(users=self.request.user)
-        return queryset
+        return scope_organizations(queryset, self.request.user)
 
     def post(self, request, mobile_app_id):
         """
@@ -414,9 +747,8 @@ class MobileAppOrganizationView(MobileListAPIView):
             If the request is successful, the request returns an HTTP 201 "CREATED" response.
         """
         try:
-            mobileapp = MobileApp.objects.get(id=mobile_app_id)
-            for organization in Organization.objects.filter(id__in=request.data['organizations']):
-                mobileapp.organizations.add(organization)
+            mobileapp = MobileApp.objects.only('id').get(id=mobile_app_id)
+            add_members(mobileapp, 'organizations', request.data['organizations'])
 
             return Response({}, status=status.HTTP_201_CREATED)
         except ObjectDoesNotExist:
@@ -435,16 +767,42 @@ class MobileAppOrganizationView(MobileListAPIView):
             If the request is successful, the request returns an HTTP 204 "NO CONTENT" response.
         """
         try:
-            mobileapp = MobileApp.objects.get(id=mobile_app_id)
-            for organization in Organization.objects.filter(id__in=request.data['organizations']):
-                mobileapp.organizations.remove(organization)
+            mobileapp = MobileApp.objects.only('id').get(id=mobile_app_id)
+            remove_members(mobileapp, 'organizations', request.data['organizations'])
 
             return Response({}, status=status.HTTP_204_NO_CONTENT)
         except ObjectDoesNotExist:
             raise Http404
 
+    def put(self, request, mobile_app_id):
+        """
+        **PUT Parameters**
+
+            The body of the PUT request must include the following parameters.
+
+            * organizations: list of all the organization ids the mobile app should have, other organizations are removed
+
+        **Response Values**
+
+            If the request is successful, the request returns an HTTP 200 "OK" response.
+
+            * added: Number of organizations added to the mobile app
+            * removed: Number of organizations removed from the mobile app
+        """
+        organization_ids = request.data.get('organizations', None)
+        if not isinstance(organization_ids, list):
+            return Response({'message': _('organizations must be a list of ids')}, status.HTTP_400_BAD_REQUEST)
+
+        mobileapp = get_object_or_404(MobileApp.objects.only('id'), pk=mobile_app_id)
+        try:
+            added, removed = sync_members(mobileapp, 'organizations', organization_ids)
+        except (TypeError, ValueError):
+            return Response({'message': _('organizations must be a list of ids')}, status.HTTP_400_BAD_REQUEST)
+
+        return Response({'added': added, 'removed': removed}, status=status.HTTP_200_OK)
+
 
-class MobileAppsNotifications(MobileAPIView):
+class MobileAppsNotifications(IdempotentPostMixin, MobileAPIView):
     """
     **Use Cases**
 
@@ -466,11 +824,15 @@ class MobileAppsNotifications(MobileAPIView):
         The HTTP 202 response has the following value.
 
         * message: Accepted
+
+        A POST with the `Idempotency-Key` header of an earlier successful one returns
+        its response again, without sending the notification again.
+        Reusing the key with a different body returns an HTTP 422 "Unprocessable Entity" response.
     """
     def __init__(self):
         self.permission_classes += (IsStaffOrReadOnlyView,)
 
-    def post(self, request):
+    def idempotent_post(self, request):
 
         message = request.data.get('message', None)
         if not message:
@@ -485,7 +847,7 @@ class MobileAppsNotifications(MobileAPIView):
             for mobile_app in mobile_apps:
                 notification_provider = mobile_app.get_notification_provider_name()
                 api_keys = mobile_app.get_api_keys()
-                notification_message = _create_notification_message(mobile_app.id, payload)
+                notification_message = create_notification_message(mobile_app.id, payload)
 
                 # Send the notification_msg to the Celery task
                 publish_mobile_apps_notifications_task.delay([], notification_message, api_keys, notification_provider)
@@ -495,7 +857,7 @@ class MobileAppsNotifications(MobileAPIView):
         return Response({'message': _('Accepted')}, status.HTTP_202_ACCEPTED)
 
 
-class MobileAppAllUsersNotifications(MobileAPIView):
+class MobileAppAllUsersNotifications(IdempotentPostMixin, MobileAPIView):
     """
     **Use Cases**
 
@@ -517,11 +879,15 @@ class MobileAppAllUsersNotifications(MobileAPIView):
         The HTTP 202 response has the following value.
 
         * message: Accepted
+
+        A POST with the `Idempotency-Key` header of an earlier successful one returns
+        its response again, without sending the notification again.
+        Reusing the key with a different body returns an HTTP 422 "Unprocessable Entity" response.
     """
     def __init__(self):
         self.permission_classes += (IsStaffOrReadOnlyView,)
 
-    def post(self, request, mobile_app_id):
+    def idempotent_post(self, request, mobile_app_id):
 
         message = request.data.get('message', None)
         if not message:
@@ -544,7 +910,7 @@ class MobileAppAllUsersNotifications(MobileAPIView):
                 'title': message,
                 'send_to_all': True
             }
-            notification_message = _create_notification_message(mobile_app.id, payload)
+            notification_message = create_notification_message(mobile_app.id, payload)
 
             # Send the notification_msg to the Celery task
             publish_mobile_apps_notifications_task.delay([], notification_message, api_keys, notification_provider)
@@ -555,7 +921,7 @@ class MobileAppAllUsersNotifications(MobileAPIView):
         return Response({'message': _('Accepted')}, status.HTTP_202_ACCEPTED)
 
 
-class MobileAppSelectedUsersNotifications(MobileAPIView):
+class MobileAppSelectedUsersNotifications(IdempotentPostMixin, MobileAPIView):
     """
     **Use Cases**
 
@@ -569,7 +935,8 @@ class MobileAppSelectedUsersNotifications(MobileAPIView):
         The body of the POST request must include the following parameters.
 
         * message: notification message
-        * users: comma separated list of user ids
+        * users: comma separated list of user ids; ids which are repeated or aren't
+          users of the app are skipped
 
     **Response Values**
 
@@ -578,12 +945,16 @@ class MobileAppSelectedUsersNotifications(MobileAPIView):
         The HTTP 202 response has the following value.
 
         * message: Accepted
+
+        A POST with the `Idempotency-Key` header of an earlier successful one returns
+        its response again, without sending the notification again.
+        Reusing the key with a different body returns an HTTP 422 "Unprocessable Entity" response.
     """
 
     def __init__(self):
         self.permission_classes += (IsStaffOrReadOnlyView,)
 
-    def post(self, request, mobile_app_id):
+    def idempotent_post(self, request, mobile_app_id):
 
         message = request.data.get('message', None)
         if not message:
@@ -604,14 +975,24 @@ class MobileAppSelectedUsersNotifications(MobileAPIView):
         except ObjectDoesNotExist:
             return Response({'message': _('Mobile app does not exist')}, status.HTTP_404_NOT_FOUND)
 
+        if isinstance(user_ids, str):
+            user_ids = user_ids.split(',')
+        try:
+            # Each user is notified once, and only if they are a user of the app
+            user_ids = get_member_ids(mobile_app, 'users', user_ids)
+        except (TypeError, ValueError):
+            return Response({'message': _('Users list must contain user ids')}, status.HTTP_400_BAD_REQUEST)
+
         try:
             api_keys = mobile_app.get_api_keys()
             payload = {'title': message}
-            notification_message = _create_notification_message(mobile_app.id, payload)
+            notification_message = create_notification_message(mobile_app.id, payload)
 
-            # Send the notification_msg to the Celery task
-            publish_mobile_apps_notifications_task.delay(user_ids, notification_message, api_keys,
-                                                         notification_provider)
+            # Send the notification_msg to the Celery tasks, in batches of users
+            dispatch_mobile_apps_notifications(
+                chunked(user_ids, get_notification_batch_size()), notification_message, api_keys,
+                notification_provider,
+            )
 
         except Exception as ex:
             return Response({'message':  _('Server error')}, status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -619,7 +1000,7 @@ class MobileAppSelectedUsersNotifications(MobileAPIView):
         return Response({'message': _('Accepted')}, status.HTTP_202_ACCEPTED)
 
 
-class MobileAppOrganizationAllUsersNotifications(MobileAPIView):
+class MobileAppOrganizationAllUsersNotifications(IdempotentPostMixin, MobileAPIView):
     """
     **Use Cases**
 
@@ -641,11 +1022,15 @@ class MobileAppOrganizationAllUsersNotifications(MobileAPIView):
         The HTTP 202 response has the following value.
 
         * message: Accepted
+
+        A POST with the `Idempotency-Key` header of an earlier successful one returns
+        its response again, without sending the notification again.
+        Reusing the key with a different body returns an HTTP 422 "Unprocessable Entity" response.
     """
     def __init__(self):
         self.permission_classes += (IsStaffOrReadOnlyView,)
 
-    def post(self, request, mobile_app_id, organization_id):
+    def idempotent_post(self, request, mobile_app_id, organization_id):
 
         message = request.data.get('message', None)
         if not message:
@@ -662,21 +1047,19 @@ class MobileAppOrganizationAllUsersNotifications(MobileAPIView):
         except ObjectDoesNotExist:
             return Response({'message': _('Mobile app does not exist')}, status.HTTP_404_NOT_FOUND)
 
-        try:
-            organization = mobile_app.organizations.get(id=organization_id)
-            user_ids = organization.users.values_list('id', flat=True).all()
-        except ObjectDoesNotExist:
+        if not mobile_app.organizations.filter(id=organization_id).exists():
             return Response({'message': _('Organization is not associated with mobile app')},
                             status.HTTP_400_BAD_REQUEST)
 
         try:
-            api_keys = mobile_app.get_api_keys()
-            payload = {'title': message}
-            notification_message = _create_notification_message(mobile_app.id, payload)
+            notification_send = MobileAppNotificationSend.objects.create(
+                mobile_app=mobile_app,
+                organization_id=organization_id,
+                payload=json.dumps({'title': message}),
+            )
 
-            # Send the notification_msg to the Celery task
-            publish_mobile_apps_notifications_task.delay(user_ids, notification_message, api_keys,
-                                                         notification_provider)
+            # The users of the organization are looked up by the Celery task, once the send is saved
+            transaction.on_commit(lambda: publish_organization_notifications_task.delay(notification_send.id))
 
         except Exception as ex:  # pylint: disable=broad-except
             return Response({'message':  _('Server error')}, status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -684,16 +1067,6 @@ class MobileAppOrganizationAllUsersNotifications(MobileAPIView):
         return Response({'message': _('Accepted')}, status.HTTP_202_ACCEPTED)
 
 
-def _create_notification_message(app_id, payload):
-    notification_type = get_notification_type('open-edx.mobileapps.notifications')
-    notification_message = NotificationMessage(
-        namespace=str(app_id),
-        msg_type=notification_type,
-        payload=payload
-    )
-    return notification_message
-
-
 def _make_upload_dt():
         """
         Generate a server-side timestamp for the upload. This is in a separate
@@ -702,7 +1075,7 @@ def _make_upload_dt():
         return datetime.datetime.utcnow().replace(tzinfo=utc)
 
 
-class OrganizationThemeView(MobileListCreateAPIView):
+class OrganizationThemeView(ConditionalGetMixin, CursorPaginationMixin, MobileListCreateAPIView):
     """
     **Use Case**
 
@@ -711,6 +1084,7 @@ class OrganizationThemeView(MobileListCreateAPIView):
     **Example Requests**
 
         GET /api/server/mobileapps/organization/{id}/themes
+        GET /api/server/mobileapps/organization/{id}/themes?cursor={cursor}
         POST /api/server/mobileapps/organization/{id}/themes
 
         **POST Parameters**
@@ -734,6 +1108,8 @@ class OrganizationThemeView(MobileListCreateAPIView):
         If the request is successful, the request returns an HTTP 200 "OK" response.
 
         The HTTP 200 response has a paginated list of objects with the following values.
+        With `cursor`, empty for the first page, the list is ordered by most recently
+        created and has `next` and `previous` cursor links instead of `count` and `num_pages`.
 
         * id: ID of the mobile app.
         * created: Datetime it was created in.
@@ -801,6 +1177,7 @@ class OrganizationThemeView(MobileListCreateAPIView):
     """
 
     serializer_class = ThemeSerializer
+    cursor_pagination_class = ThemePagination
 
     def __init__(self):
         self.permission_classes += (IsStaffOrReadOnlyView,)
@@ -810,10 +1187,7 @@ class OrganizationThemeView(MobileListCreateAPIView):
         Optionally restricts the returned themes to active only.
         """
         queryset = Theme.objects.filter(active=True, organization_id=self.kwargs['organization_id'])
-        if not self.request.user.is_staff:
-            user_organizations = self.request.user.organizations.all()
-            queryset = queryset.filter(organization__in=user_organizations)
-        return queryset
+        return scope_themes(queryset, self.request.user)
 
     @transaction.atomic
     def post(self, request, organization_id):
@@ -867,7 +1241,7 @@ class OrganizationThemeView(MobileListCreateAPIView):
             return Response(status=status.HTTP_201_CREATED)
 
 
-class OrganizationThemeDetailView(MobileRetrieveUpdateDestroyAPIView):
+class OrganizationThemeDetailView(ConditionalGetMixin, MobileRetrieveUpdateDestroyAPIView):
     """
     **Use Case**
 
@@ -1030,11 +1404,10 @@ class OrganizationThemeDetailView(MobileRetrieveUpdateDestroyAPIView):
         """
         Optionally restricts the returned themes only user's organizatons in case of non staff users.
         """
-        queryset = Theme.objects.all()
-        if not self.request.user.is_staff:
-            user_organizations = self.request.user.organizations.all()
-            queryset = queryset.filter(organization__in=user_organizations)
-        return queryset
+        return scope_themes(Theme.objects.all(), self.request.user)
+
+    def get_conditional_queryset(self):
+        return self.get_queryset().filter(pk=self.kwargs['theme_id'])
 
     @transaction.atomic
     def patch(self, request, theme_id):